@@ -0,0 +1,200 @@
+"""
+Time-of-day profile of insulin and glucose across many days.
+
+Each series is reshaped into a (days x slots) matrix on the patient's local wall clock, with one
+cell per local day and time-of-day slot. A cell holds the mean of what falls into it: U/h for
+basal, bolus and total (from the per-interval delivery) and mmol/L for glucose (from the CGM
+readings). Percentiles, means and coverage (share of days with data) are then taken down every
+slot at once. The conversion to local time follows the timezone's DST rules. On a spring-forward
+day the skipped hour's cells stay empty, and on a fall-back day the repeated hour's two intervals
+share a cell.
+"""
+from datetime import date, datetime, timedelta
+from zoneinfo import ZoneInfo
+import numpy as np
+
+import instrumentation
+from records import TARGET_HIGH, TARGET_LOW, datetime_ms
+
+MS_PER_DAY = 86_400_000
+# UTC offsets are checked at quarter hours on days where they change; every zone's changes fall on one
+OFFSET_STEP_MS = 15 * 60_000
+PERCENTILES = (10, 25, 50, 75, 90)
+
+
+def utc_offset_ms(ms: int, tz) -> int:
+    return datetime.fromtimestamp(ms / 1000, tz).utcoffset() // timedelta(milliseconds=1)
+
+
+def local_ms(ms, tz) -> np.ndarray:
+    """Wall-clock time in `tz`, as epoch ms, of an array of UTC epoch ms."""
+    ms = np.asarray(ms, dtype=np.int64)
+    if len(ms) == 0:
+        return ms
+    # the offset at each UTC midnight, refined only on the days it changes during
+    first_day, last_day = ms.min() // MS_PER_DAY, ms.max() // MS_PER_DAY
+    midnights = np.arange(first_day, last_day + 2, dtype=np.int64) * MS_PER_DAY
+    day_offsets = np.array([utc_offset_ms(int(midnight), tz) for midnight in midnights], dtype=np.int64)
+    day = ms // MS_PER_DAY - first_day
+    offsets = day_offsets[day]
+    for changing in np.flatnonzero(day_offsets[:-1] != day_offsets[1:]):
+        grid = midnights[changing] + OFFSET_STEP_MS * np.arange(MS_PER_DAY // OFFSET_STEP_MS, dtype=np.int64)
+        grid_offsets = np.array([utc_offset_ms(int(when), tz) for when in grid], dtype=np.int64)
+        on_day = day == changing
+        offsets[on_day] = grid_offsets[(ms[on_day] - midnights[changing]) // OFFSET_STEP_MS]
+    return ms + offsets
+
+
+def time_of_day_matrix(ms, values, tz, slot_minutes: int = 60):
+    """
+    (local dates, days x slots matrix of cell means) for values stamped with UTC epoch ms.
+    Cells without data are NaN.
+    """
+    slot = slot_minutes * 60_000
+    local = local_ms(ms, tz)
+    values = np.asarray(values, dtype=float)
+    n_slots = MS_PER_DAY // slot
+    if len(local) == 0:
+        return [], np.full((0, n_slots), np.nan)
+    day = local // MS_PER_DAY
+    first_day = int(day.min())
+    n_days = int(day.max()) - first_day + 1
+    cell = (day - first_day) * n_slots + local % MS_PER_DAY // slot
+    counts = np.bincount(cell, minlength=n_days * n_slots)
+    sums = np.bincount(cell, weights=values, minlength=n_days * n_slots)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        matrix = np.where(counts > 0, sums / counts, np.nan).reshape(n_days, n_slots)
+    dates = [date(1970, 1, 1) + timedelta(days=first_day + offset) for offset in range(n_days)]
+    return dates, matrix
+
+
+def slot_stats(matrix, percentiles=PERCENTILES) -> dict:
+    """Mean, percentiles ('p50' etc.) and coverage of every slot (column), NaN where a slot has no data."""
+    have = ~np.isnan(matrix)
+    days_with_data = have.sum(axis=0)
+    stats = {'coverage': days_with_data / matrix.shape[0] if matrix.shape[0] else np.zeros(matrix.shape[1])}
+    with np.errstate(invalid='ignore', divide='ignore'):
+        stats['mean'] = np.where(days_with_data > 0, np.nansum(matrix, axis=0) / days_with_data, np.nan)
+    # slots without any data are zero-filled so nanpercentile doesn't warn, then set to NaN
+    values = np.nanpercentile(np.where(have.any(axis=0), matrix, 0.0), percentiles, axis=0)
+    for q, row in zip(percentiles, values):
+        stats[f'p{q}'] = np.where(days_with_data > 0, row, np.nan)
+    return stats
+
+
+def delivery_rates(delivery, interval_minutes: int = 60, start: datetime = None, end: datetime = None):
+    """
+    (interval start ms, basal U/h, bolus U/h) of the DataFrame or hourly dict from
+    calculate_insulin_delivery. The first and last intervals only cover the part of them inside
+    [start, end), so their units are spread over that part; intervals outside it are dropped.
+    """
+    if hasattr(delivery, "index"):
+        ends = delivery.index.as_unit("ms").asi8
+        basal, bolus = delivery['basal'].to_numpy(dtype=float), delivery['bolus'].to_numpy(dtype=float)
+    else:
+        times = sorted(delivery)
+        ends = np.array([datetime_ms(time) for time in times], dtype=np.int64)
+        basal = np.array([delivery[time]['basal'] for time in times], dtype=float)
+        bolus = np.array([delivery[time]['bolus'] for time in times], dtype=float)
+    starts = ends - interval_minutes * 60_000
+    covered = np.minimum(ends, np.inf if end is None else datetime_ms(end)) - \
+        np.maximum(starts, -np.inf if start is None else datetime_ms(start))
+    inside = covered > 0
+    per_hour = 3_600_000 / covered[inside]
+    return starts[inside], basal[inside] * per_hour, bolus[inside] * per_hour
+
+
+def glucose_arrays(glucose, start: datetime = None, end: datetime = None):
+    """(UTC epoch ms, mmol/L) of a records.GlucoseSeries or {datetime: mmol/L} dict, within [start, end]."""
+    if hasattr(glucose, "times"):
+        if start is not None and end is not None:
+            glucose = glucose.window(start, end)
+        return glucose.times, glucose.values
+    items = sorted((time, value) for time, value in glucose.items()
+                   if (start is None or time >= start) and (end is None or time <= end))
+    return (np.array([datetime_ms(time) for time, _ in items], dtype=np.int64),
+            np.array([value for _, value in items], dtype=float))
+
+
+@instrumentation.timed("ambulatory_profile")
+def ambulatory_profile(delivery, glucose, tz, *, start: datetime = None, end: datetime = None,
+                       slot_minutes: int = 60, interval_minutes: int = 60, percentiles=PERCENTILES) -> dict:
+    """
+    Time-of-day statistics of basal, bolus, total (U/h) and glucose (mmol/L) over the days covered.
+
+    delivery is the per-interval output of calculate_insulin_delivery (slot_minutes must be a
+    multiple of its interval) and glucose a GlucoseSeries or {datetime: mmol/L} dict; either may be
+    None. Returns {'slots': slot start minutes after local midnight, 'slot_minutes', 'tz',
+    'basal'/'bolus'/'total'/'glucose': {'dates', 'matrix', 'mean', 'p10' ... 'p90', 'coverage'}}.
+    """
+    if (24 * 60) % slot_minutes:
+        raise ValueError(f"slot_minutes must divide a day, got {slot_minutes}")
+    if delivery is not None and slot_minutes % interval_minutes:
+        raise ValueError(f"slot_minutes must be a multiple of the {interval_minutes} minute delivery interval, "
+                         f"got {slot_minutes}")
+    tz = ZoneInfo(tz) if isinstance(tz, str) else tz
+    profile = {'slots': np.arange(0, 24 * 60, slot_minutes), 'slot_minutes': slot_minutes, 'tz': tz}
+    series = {}
+    if delivery is not None:
+        starts, basal, bolus = delivery_rates(delivery, interval_minutes, start, end)
+        series.update(basal=(starts, basal), bolus=(starts, bolus), total=(starts, basal + bolus))
+    if glucose is not None:
+        series['glucose'] = glucose_arrays(glucose, start, end)
+    for name, (ms, values) in series.items():
+        dates, matrix = time_of_day_matrix(ms, values, tz, slot_minutes)
+        profile[name] = {'dates': dates, 'matrix': matrix, **slot_stats(matrix, percentiles)}
+    return profile
+
+
+def slot_rows(profile: dict, stats=("p25", "p50", "p75", "coverage")) -> list:
+    """One dict per slot ({'slot': 'HH:MM', 'basal_p50': ...}) for tables and JSON; None where there's no data."""
+    names = [name for name in ('basal', 'bolus', 'total', 'glucose') if name in profile]
+    rows = []
+    for index, minutes in enumerate(profile['slots'].tolist()):
+        row = {'slot': f"{minutes // 60:02d}:{minutes % 60:02d}"}
+        for name in names:
+            for stat in stats:
+                value = float(profile[name][stat][index])
+                row[f"{name}_{stat}"] = None if np.isnan(value) else value
+        rows.append(row)
+    return rows
+
+
+@instrumentation.timed("plot.ambulatory_profile")
+def ambulatory_profile_plot(profile: dict):
+    """Median and interquartile range by time of day: insulin (U/h) above, glucose below."""
+    # plotting libraries are only loaded once a plot is asked for
+    import matplotlib.pyplot as plt
+
+    hours = np.append(profile['slots'], 24 * 60) / 60
+    fig, (insulin_ax, glucose_ax) = plt.subplots(2, 1, figsize=(10, 8), sharex=True)
+
+    if 'total' in profile:
+        for name, color in (('total', 'tab:orange'), ('basal', 'tab:blue')):
+            stats = profile[name]
+            insulin_ax.stairs(stats['p50'], hours, color=color, label=f"{name.capitalize()} median")
+            insulin_ax.stairs(stats['p75'], hours, baseline=stats['p25'], fill=True, color=color, alpha=0.25,
+                              label=f"{name.capitalize()} IQR")
+    insulin_ax.set_title(f"Insulin by Time of Day ({profile['tz']})")
+    insulin_ax.set_ylabel("Insulin (U/h)")
+    insulin_ax.legend()
+    insulin_ax.grid(True)
+
+    if 'glucose' in profile:
+        stats = profile['glucose']
+        middle = profile['slots'] / 60 + profile['slot_minutes'] / 120
+        glucose_ax.fill_between(middle, stats['p10'], stats['p90'], color='tab:green', alpha=0.15, label="10-90%")
+        glucose_ax.fill_between(middle, stats['p25'], stats['p75'], color='tab:green', alpha=0.35, label="IQR")
+        glucose_ax.plot(middle, stats['p50'], color='tab:green', label="Median")
+        glucose_ax.axhline(TARGET_LOW, color='grey', linestyle='--', linewidth=1)
+        glucose_ax.axhline(TARGET_HIGH, color='grey', linestyle='--', linewidth=1)
+    glucose_ax.set_title("Glucose by Time of Day")
+    glucose_ax.set_xlabel("Time of day (h)")
+    glucose_ax.set_ylabel("Glucose (mmol/L)")
+    glucose_ax.set_ylim(0, 22)
+    glucose_ax.set_xlim(0, 24)
+    glucose_ax.set_xticks(range(0, 25, 3))
+    glucose_ax.legend()
+    glucose_ax.grid(True)
+
+    return fig
@@ -1,6 +1,13 @@
 from dataretriever import *
+from profileindex import ProfileIndex
+from basalschedule import BasalSchedule
+from itertools import chain
+import instrumentation
 import pytz
 
+# Profile switch timestamps already seen, per NSID
+PROFILE_INDEX = ProfileIndex()
+
 # assumes default profile is being used !!!! MAY NOT WORK WITH MULTIPROFILE IN LOOP/AAPS!!!
 def basalprofiles(profiles):
     basalprofile = {}
@@ -17,11 +24,14 @@ def basalprofiles(profiles):
 
         basaldic = store[default_key]['basal']
         timezone = store[default_key]['timezone']
-        basalprofile[date] = [timezone, basaldic]
+        # duration of insulin action in hours, None when the profile doesn't set one
+        dia = store[default_key].get('dia')
+        basalprofile[date] = [timezone, basaldic, dia]
 
     return basalprofile
 
 # Check to confirm the patient's profiles are in their timezones but the start dates are not
+@instrumentation.timed("basaltimes")
 def basaltimes(basal_data, enddate):
     # Get the dates of each profile
     listofdates = []
@@ -56,32 +66,87 @@ def basaltimes(basal_data, enddate):
 
     return basal_dict
 
-def basalinsulin(nsid:str, startdate:str, enddate:str):
+def profilerate(profile, when):
+    # rate of a [timezone, basaldic] profile at an aware datetime
+    local_time = when.astimezone(pytz.timezone(profile[0]))
+    rate = profile[1][0]['value']
+    for entry in profile[1]:
+        hour, minute = entry['time'].split(':')[:2]
+        if (int(hour), int(minute)) <= (local_time.hour, local_time.minute):
+            rate = entry['value']
+    return rate
+
+def basalinsulin(nsid:str, startdate:str, enddate:str, page_size:int = PAGE_SIZE, mode:str = "latest",
+                 compiled:bool = False):
+    """
+    mode="latest" starts from the last indexed profile switch before startdate, or asks for the
+    newest profile before it in one query; mode="scan" is the original backwards window search.
+    compiled=True returns a basalschedule.BasalSchedule instead of the expanded {time: rate} dict.
+    """
+    with instrumentation.stage("profiles." + mode):
+        if mode == "latest":
+            basalrates = latestprofiles(nsid, startdate, enddate, page_size)
+        elif mode == "scan":
+            basalrates = scanprofiles(nsid, startdate, enddate, page_size)
+        else:
+            raise ValueError(f"Unknown profile mode {mode!r}")
+    PROFILE_INDEX.add(nsid, basalrates)
+    if compiled:
+        with instrumentation.stage("basalschedule.compile"):
+            return BasalSchedule(basalrates, enddate)
+
+    # [print(date, basal) for date, basal in basalrates.items()]
+    basaldict = basaltimes(basalrates, enddate)
+    if mode == "latest":
+        # no older profile is fetched to cover the gap between the first switch and its next
+        # scheduled entry, so start the schedule with the rate in effect at the switch itself
+        first = min(basalrates)
+        switch = pytz.utc.localize(datetime.fromisoformat(first))
+        basaldict.setdefault(switch, profilerate(basalrates[first], switch))
+    # print(basaldict)
+    return basaldict
+
+def latestprofiles(nsid:str, startdate:str, enddate:str, page_size:int = PAGE_SIZE):
+    known = PROFILE_INDEX.latest_before(nsid, startdate)
+    if known:
+        # every switch from the known one onwards, which includes the one active at startdate
+        rows = recordFetcher(nsid, "profiles", known, enddate, page_size=page_size)
+    else:
+        rows = chain(newestBefore(nsid, "profiles", startdate),
+                     recordFetcher(nsid, "profiles", startdate, enddate, page_size=page_size))
+    basalrates = basalprofiles(rows)
+    if not basalrates or min(basalrates) > startdate:
+        raise ValueError("No profile found before the start date!")
+    return basalrates
+
+def scanprofiles(nsid:str, startdate:str, enddate:str, page_size:int = PAGE_SIZE):
     start_anchor = datetime.fromisoformat(startdate)  # earliest point we care about
     cur_end = datetime.fromisoformat(enddate)  # sliding window upper bound
 
     buffer_days = 3
     max_buffer = 365 * 2 # stop after scanning for 2 years
-    ts_key = timestampvariable("profiles")
 
-    output_rows: list[dict] = []
+    basalrates = {}
 
     while True:
         # next window goes back `buffer_days` from cur_end
         cur_start = cur_end - timedelta(days=buffer_days)
 
-        rows = dataFetcher(
+        rows = recordFetcher(
             nsid,
             "profiles",
             cur_start.isoformat(timespec="seconds"),
             cur_end.isoformat(timespec="seconds"),
+            page_size=page_size,
         )
+        window_rates = basalprofiles(rows)
+        instrumentation.count("profiles.scan_windows")
 
-        if rows:  # ✔ got data
-            output_rows.extend(rows)
+        if window_rates:  # ✔ got data
+            basalrates.update(window_rates)
 
             # stop once we’ve crossed the original anchor
-            if datetime.fromisoformat(timeclean(rows[-1][ts_key])) <= start_anchor:
+            if datetime.fromisoformat(min(window_rates)) <= start_anchor:
                 break
 
             # slide the window back (avoid overlap by 1 s)
@@ -92,10 +157,8 @@ def basalinsulin(nsid:str, startdate:str, enddate:str):
                 raise ValueError("Reached two years with no profile changes!")
             buffer_days *= 2  # widen the net
 
-    #[print(n) for n in output_rows]
-    basalrates = basalprofiles(output_rows)
-    # [print(date, basal) for date, basal in basalrates.items()]
-    basaldict = basaltimes(basalrates, enddate)
-    # print(basaldict)
-    return basaldict
+    return basalrates
 
+def basalschedule(nsid:str, startdate:str, enddate:str, page_size:int = PAGE_SIZE):
+    """basalinsulin returning the compiled BasalSchedule."""
+    return basalinsulin(nsid, startdate, enddate, page_size, compiled=True)
@@ -0,0 +1,113 @@
+"""
+Compiled basal schedule.
+
+Each profile from basalinsulin.basalprofiles is compiled once into sorted seconds-of-day offsets
+and rates, and profile switches into sorted epoch seconds, so "rate at t" and "next change after t"
+are bisects instead of a day-by-day expansion. Wall-clock entries are resolved in the profile's
+timezone for the day in question, so DST days get the right UTC instants.
+"""
+from bisect import bisect_right
+from datetime import datetime, timedelta, timezone, time
+from zoneinfo import ZoneInfo
+
+
+def entry_offset(entry) -> int:
+    # seconds since local midnight for a profile basal entry
+    if 'timeAsSeconds' in entry:
+        return int(entry['timeAsSeconds'])
+    hour, minute = entry['time'].split(':')[:2]
+    return int(hour) * 3600 + int(minute) * 60
+
+
+class CompiledProfile:
+    __slots__ = ("start", "tz", "offsets", "rates", "dia")
+
+    def __init__(self, start: float, timezone_name: str, basal_entries: list, dia=None):
+        entries = sorted((entry_offset(entry), entry['value']) for entry in basal_entries)
+        if not entries:
+            raise ValueError(f"Profile starting at {datetime.fromtimestamp(start, timezone.utc).isoformat()} "
+                             "has no basal entries")
+        self.start = start
+        self.tz = ZoneInfo(timezone_name)
+        self.dia = float(dia) if dia else None
+        self.offsets = [offset for offset, _ in entries]
+        self.rates = [rate for _, rate in entries]
+
+    def rate_at(self, local: datetime):
+        seconds = local.hour * 3600 + local.minute * 60 + local.second
+        # before the first entry of the day the previous day's last entry is still running
+        return self.rates[bisect_right(self.offsets, seconds) - 1]
+
+    def next_change(self, when: datetime) -> datetime:
+        """First scheduled entry strictly after the aware datetime `when`."""
+        local = when.astimezone(self.tz)
+        seconds = local.hour * 3600 + local.minute * 60 + local.second + local.microsecond / 1e6
+        day = local.date()
+        index = bisect_right(self.offsets, seconds)
+        while True:
+            if index == len(self.offsets):
+                day += timedelta(days=1)
+                index = 0
+            offset = self.offsets[index]
+            wall = datetime.combine(day, time(offset // 3600, offset % 3600 // 60, offset % 60), tzinfo=self.tz)
+            change = wall.astimezone(timezone.utc)
+            # a repeated wall-clock hour at the end of DST can map back before `when`
+            if change > when:
+                return change
+            index += 1
+
+
+class BasalSchedule:
+    def __init__(self, basal_data: dict, enddate):
+        """basal_data is {startDate string: [timezone, basal entries, dia]} as returned by basalprofiles."""
+        self.profiles = [
+            CompiledProfile(datetime.fromisoformat(date).replace(tzinfo=timezone.utc).timestamp(), profile[0], profile[1],
+                            profile[2] if len(profile) > 2 else None)
+            for date, profile in sorted(basal_data.items())
+        ]
+        self.starts = [profile.start for profile in self.profiles]
+        self.end = datetime.fromisoformat(str(enddate)).replace(tzinfo=timezone.utc)
+
+    def _profile(self, when: datetime):
+        index = bisect_right(self.starts, when.timestamp()) - 1
+        return (index, self.profiles[index]) if index >= 0 else (index, None)
+
+    def rate_at(self, when: datetime):
+        """Scheduled rate at an aware datetime, or None before the first profile."""
+        _, profile = self._profile(when)
+        if profile is None:
+            return None
+        return profile.rate_at(when.astimezone(profile.tz))
+
+    def dia_changes(self):
+        """(epoch seconds, dia hours or None) for each profile switch."""
+        return [(profile.start, profile.dia) for profile in self.profiles]
+
+    def next_change(self, when: datetime):
+        """Next scheduled entry or profile switch after `when`, or None past the schedule's end."""
+        index, profile = self._profile(when)
+        candidates = []
+        if index + 1 < len(self.profiles):
+            candidates.append(datetime.fromtimestamp(self.starts[index + 1], timezone.utc))
+        if profile is not None:
+            candidates.append(profile.next_change(when))
+        change = min(candidates, default=None)
+        if change is None or change >= self.end:
+            return None
+        return change
+
+    def changes(self, start: datetime, end: datetime = None):
+        """Yield (time, rate) for the rate in effect at `start` and every change up to `end`."""
+        end = self.end if end is None else min(end, self.end)
+        when = start
+        while when is not None and when < end:
+            yield when, self.rate_at(when)
+            when = self.next_change(when)
+
+    def todict(self, start: datetime = None, end: datetime = None) -> dict:
+        """Expand to the {time: rate} dict that basaltimes builds, for callers that still need it."""
+        if start is None:
+            if not self.starts:
+                return {}
+            start = datetime.fromtimestamp(self.starts[0], timezone.utc)
+        return {when: rate for when, rate in self.changes(start, end) if rate is not None}
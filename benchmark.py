@@ -0,0 +1,209 @@
+"""
+Benchmark harness: time and peak memory per pipeline stage across dataset sizes.
+
+    python benchmark.py --days 7 30 90 --latency 0.05 --output bench_output.txt
+    python benchmark.py --imports
+
+
+Each size gets a synthetic patient (synthetic.py) served by a local stand-in Nightscout
+(standinserver.py), so the fetch stages go through the real HTTP path. Results are printed as a
+table and appended as JSON lines to --output, tagged with the git commit, so scaling curves can be
+compared between runs. --imports instead measures the cold import of the CLI entry point
+(python -X importtime in a fresh interpreter) and which heavy libraries it pulled in.
+"""
+import argparse
+import json
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+
+import basalinsulin
+import dataretriever
+import urlformater
+from basalschedule import BasalSchedule
+from columnarcalculator import columnar_insulin_delivery
+from glucosecalculator import avg_glucose_plot
+from glucosereadings import glucosedata
+from insulincalculator import calculate_insulin_delivery, hourly_insulin_plot
+from profileindex import ProfileIndex
+from records import GlucoseSeries, parse_treatments
+from standinserver import StandInServer
+from synthetic import synthetic_patient
+from treatmentinsulin import treatmenttimes
+
+NSID = "benchmark"
+HEAVY_MODULES = ("pandas", "matplotlib", "matplotlib.pyplot", "scipy", "streamlit")
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def stage_fetch_entries(ctx):
+    ctx["entries"] = dataretriever.dataFetcher(NSID, "entries", ctx["start"], ctx["end"])
+
+def stage_fetch_treatments(ctx):
+    ctx["treatments"] = dataretriever.dataFetcher(NSID, "treatments", ctx["start"], ctx["end"])
+
+def stage_fetch_profiles(ctx):
+    basalinsulin.PROFILE_INDEX = ProfileIndex(None)  # measure discovery, not the index
+    ctx["profiles"] = basalinsulin.latestprofiles(NSID, ctx["start"], ctx["end"])
+
+def stage_glucosedata(ctx):
+    ctx["glucosedic"] = glucosedata(ctx["entries"])
+
+def stage_glucoseseries(ctx):
+    ctx["glucose"] = GlucoseSeries.from_records(ctx["entries"])
+
+def stage_treatmenttimes(ctx):
+    ctx["tempdic"], ctx["bolusdic"] = treatmenttimes(ctx["treatments"])
+
+def stage_parse_treatments(ctx):
+    ctx["temps"], ctx["boluses"] = parse_treatments(ctx["treatments"])
+
+def stage_basaltimes(ctx):
+    ctx["basaldic"] = basalinsulin.basaltimes(ctx["profiles"], ctx["end"])
+
+def stage_basalschedule(ctx):
+    ctx["schedule"] = BasalSchedule(ctx["profiles"], ctx["end"])
+
+def stage_delivery_sweep(ctx):
+    ctx["hourly"] = calculate_insulin_delivery(ctx["basaldic"], ctx["tempdic"], ctx["bolusdic"],
+                                               ctx["start_time"], ctx["end_time"])[2]
+
+def stage_delivery_columnar(ctx):
+    ctx["delivery"] = columnar_insulin_delivery(ctx["schedule"], ctx["temps"], ctx["boluses"],
+                                                ctx["start_time"], ctx["end_time"])[2]
+
+def stage_delivery_legacy(ctx):
+    calculate_insulin_delivery(ctx["basaldic"], ctx["tempdic"], ctx["bolusdic"],
+                               ctx["start_time"], ctx["end_time"], engine="legacy")
+
+def stage_hourly_plot(ctx):
+    plt.close(hourly_insulin_plot(ctx["delivery"], timezone.utc))
+
+def stage_glucose_plot(ctx):
+    plt.close(avg_glucose_plot(ctx["glucose"], ctx["start_time"], ctx["end_time"], 30, timezone.utc))
+
+STAGES = [
+    ("fetch entries", stage_fetch_entries),
+    ("fetch treatments", stage_fetch_treatments),
+    ("fetch profiles", stage_fetch_profiles),
+    ("glucosedata", stage_glucosedata),
+    ("GlucoseSeries", stage_glucoseseries),
+    ("treatmenttimes", stage_treatmenttimes),
+    ("parse_treatments", stage_parse_treatments),
+    ("basaltimes", stage_basaltimes),
+    ("BasalSchedule", stage_basalschedule),
+    ("delivery sweep", stage_delivery_sweep),
+    ("delivery columnar", stage_delivery_columnar),
+    ("delivery legacy", stage_delivery_legacy),
+    ("hourly_insulin_plot", stage_hourly_plot),
+    ("avg_glucose_plot", stage_glucose_plot),
+]
+
+
+def measure(stage, ctx, repeat: int):
+    """(best wall time in seconds, peak traced memory in bytes) of a stage."""
+    best = float("inf")
+    for _ in range(repeat):
+        began = time.perf_counter()
+        stage(ctx)
+        best = min(best, time.perf_counter() - began)
+    tracemalloc.start()
+    stage(ctx)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak
+
+
+def run_benchmarks(days_list, *, repeat: int = 3, latency: float = 0.0, legacy_max_days: int = 7,
+                   temp_basals_per_hour: float = 4, profile_switches: int = 2, cgm_minutes: int = 5):
+    """Yield one result dict per (dataset size, stage)."""
+    dataretriever.useCache(None)
+    for days in days_list:
+        patient = synthetic_patient(days, start=START, cgm_minutes=cgm_minutes,
+                                    temp_basals_per_hour=temp_basals_per_hour, profile_switches=profile_switches)
+        end_time = START + timedelta(days=days)
+        ctx = {
+            "start_time": START, "end_time": end_time,
+            "start": START.replace(tzinfo=None).isoformat(timespec="seconds"),
+            "end": end_time.replace(tzinfo=None).isoformat(timespec="seconds"),
+        }
+        with StandInServer({NSID: patient}, latency=latency) as server:
+            base_url = urlformater.BASE_URL
+            urlformater.BASE_URL = server.url
+            try:
+                for name, stage in STAGES:
+                    if stage is stage_delivery_legacy and days > legacy_max_days:
+                        continue
+                    seconds, peak = measure(stage, ctx, repeat)
+                    yield {
+                        "days": days, "stage": name, "seconds": seconds, "peak_bytes": peak,
+                        "entries": len(patient["entries"]), "treatments": len(patient["treatments"]),
+                    }
+            finally:
+                urlformater.BASE_URL = base_url
+        dataretriever.POOL.close()
+
+
+def import_time(module: str = "localmain") -> dict:
+    """Cold import of `module` in a fresh interpreter: total seconds and the heavy modules it loaded."""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            capture_output=True, text=True, check=True)
+    # lines read "import time: <self us> | <cumulative us> | <indented name>"
+    cumulative = {}
+    for line in result.stderr.splitlines():
+        parts = line.split("|")
+        if line.startswith("import time:") and len(parts) == 3 and parts[1].strip().isdigit():
+            cumulative[parts[2].strip()] = int(parts[1])
+    return {
+        "stage": f"import {module}", "seconds": cumulative.get(module, 0) / 1e6,
+        "heavy": [name for name in HEAVY_MODULES if name in cumulative],
+    }
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ""
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the insulin pipeline on synthetic patients.")
+    parser.add_argument("--days", type=int, nargs="+", default=[7, 30, 90], help="dataset sizes in days")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per stage (best is kept)")
+    parser.add_argument("--latency", type=float, default=0.0, help="stand-in server latency per request (s)")
+    parser.add_argument("--temp-basals-per-hour", type=float, default=4)
+    parser.add_argument("--profile-switches", type=int, default=2)
+    parser.add_argument("--cgm-minutes", type=int, default=5)
+    parser.add_argument("--legacy-max-days", type=int, default=7, help="skip the legacy engine above this size")
+    parser.add_argument("--output", default="bench_output.txt", help="JSON lines file results are appended to")
+    parser.add_argument("--imports", action="store_true", help="measure the CLI's cold import time instead")
+    args = parser.parse_args()
+
+    run = {"commit": git_commit(), "at": datetime.now(timezone.utc).isoformat(timespec="seconds")}
+    if args.imports:
+        result = import_time()
+        print(f"{result['stage']}: {result['seconds']:.3f}s, heavy modules: {', '.join(result['heavy']) or 'none'}")
+        with open(args.output, "a") as out:
+            out.write(json.dumps({**run, **result}) + "\n")
+        return
+
+    print(f"{'days':>5} {'stage':<22} {'seconds':>10} {'peak MiB':>10}")
+    with open(args.output, "a") as out:
+        for result in run_benchmarks(args.days, repeat=args.repeat, latency=args.latency,
+                                     legacy_max_days=args.legacy_max_days,
+                                     temp_basals_per_hour=args.temp_basals_per_hour,
+                                     profile_switches=args.profile_switches, cgm_minutes=args.cgm_minutes):
+            print(f"{result['days']:>5} {result['stage']:<22} {result['seconds']:>10.4f} "
+                  f"{result['peak_bytes'] / 2 ** 20:>10.2f}")
+            out.write(json.dumps({**run, **result}) + "\n")
+
+
+if __name__ == "__main__":
+    main()
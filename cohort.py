@@ -0,0 +1,140 @@
+"""
+Batch cohort mode: insulin and glucose totals for many patients and windows.
+
+    python cohort.py manifest.csv summary.csv --workers 8 --per-host 2
+
+The manifest is a CSV with nsid,start,end,tz columns (or a JSON list of objects with the same keys).
+start and end are local times in tz ("2026-01-20 00:00"); tz defaults to UTC. Every row is fetched
+and calculated in a process pool and written to one summary table, with the error recorded instead
+of the totals when a row fails.
+"""
+import argparse
+import csv
+import json
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from urllib.parse import urlsplit
+from zoneinfo import ZoneInfo
+
+import dataretriever
+from basalinsulin import basalschedule
+from treatmentinsulin import treatmentinsulin
+from glucosereadings import glucosereadings
+from insulincalculator import calculate_insulin_delivery
+from glucosecalculator import average_glucose
+from responsecache import ResponseCache
+from urlformater import baseurl, PAGE_SIZE
+
+FIELDS = ['nsid', 'start', 'end', 'tz', 'Basal (U)', 'Bolus (U)', 'Total (U)', 'Avg BG (mM)', 'error']
+
+
+def read_manifest(path: str) -> list:
+    if path.endswith(".json"):
+        with open(path) as f:
+            rows = json.load(f)
+    else:
+        with open(path, newline="") as f:
+            rows = list(csv.DictReader(f))
+    return [{key: (row.get(key) or "").strip() for key in ('nsid', 'start', 'end', 'tz')} for row in rows]
+
+
+def host(nsid: str) -> str:
+    return urlsplit(baseurl(nsid)).netloc
+
+
+def server(nsid: str) -> str:
+    """The address behind a patient's host: every NSID is its own subdomain of the same server."""
+    netloc = host(nsid)
+    return netloc[len(nsid) + 1:] if netloc.startswith(nsid + ".") else netloc
+
+
+def init_worker(hosts: dict, server_limits: dict, use_cache: bool, rate_per_worker: float):
+    # every worker bounds its requests to a server with the same cross-process semaphore, whichever
+    # patient's host they go to, and takes an equal share of the server's request rate
+    buckets = {name: dataretriever.TokenBucket(rate_per_worker, max(rate_per_worker, 1)) for name in server_limits}
+    for netloc, name in hosts.items():
+        dataretriever.POOL.setLimit(netloc, server_limits[name])
+        dataretriever.SCHEDULER.setBucket(netloc, buckets[name])
+    if use_cache:
+        dataretriever.useCache(ResponseCache())
+
+
+def summarize(row: dict) -> dict:
+    """Totals for one manifest row; any failure is captured in the 'error' field."""
+    summary = dict(row)
+    try:
+        tz = ZoneInfo(row['tz'] or "UTC")
+        starttime = datetime.fromisoformat(row['start']).replace(tzinfo=tz).astimezone(timezone.utc)
+        endtime = datetime.fromisoformat(row['end']).replace(tzinfo=tz).astimezone(timezone.utc)
+        if endtime <= starttime:
+            raise ValueError("End time must be after start time.")
+
+        starttime_naive = starttime.replace(tzinfo=None).isoformat(timespec="seconds")
+        endtime_naive = endtime.replace(tzinfo=None).isoformat(timespec="seconds")
+        fetched = dataretriever.fetchConcurrently({
+            "basal": (basalschedule, row['nsid'], starttime_naive, endtime_naive),
+            "treatments": (treatmentinsulin, row['nsid'], starttime_naive, endtime_naive, PAGE_SIZE, 1, True),
+            "glucose": (glucosereadings, row['nsid'], starttime_naive, endtime_naive, PAGE_SIZE, 1, True),
+        })
+        tempdic, bolusdic = fetched["treatments"]
+        basal_insulin, bolus_insulin, _ = calculate_insulin_delivery(fetched["basal"], tempdic, bolusdic,
+                                                                     starttime, endtime)
+        summary.update({
+            'Basal (U)': basal_insulin,
+            'Bolus (U)': bolus_insulin,
+            'Total (U)': basal_insulin + bolus_insulin,
+            'Avg BG (mM)': average_glucose(fetched["glucose"], starttime, endtime),
+            'error': "",
+        })
+    except Exception as e:
+        summary['error'] = f"{type(e).__name__}: {e}"
+    return summary
+
+
+def run_cohort(rows: list, workers: int = 4, per_host: int = 2, use_cache: bool = False,
+               rate: float = dataretriever.REQUESTS_PER_SECOND):
+    """
+    Yield one summary per manifest row, in manifest order. per_host (concurrent requests) and rate
+    (requests/s) apply to each Nightscout server across all workers and all its patients.
+    """
+    hosts = {host(row['nsid']): server(row['nsid']) for row in rows}
+    with multiprocessing.Manager() as manager:
+        server_limits = {name: manager.BoundedSemaphore(per_host) for name in set(hosts.values())}
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                                 initargs=(hosts, server_limits, use_cache, rate / workers)) as executor:
+            yield from executor.map(summarize, rows)
+
+
+def write_summary(summaries, path: str):
+    if path.endswith(".json"):
+        with open(path, "w") as f:
+            json.dump(list(summaries), f, indent=2)
+        return
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=FIELDS)
+        writer.writeheader()
+        for summary in summaries:
+            writer.writerow(summary)
+            f.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Insulin and glucose totals for a cohort manifest.")
+    parser.add_argument("manifest", help="CSV or JSON rows of nsid,start,end,tz")
+    parser.add_argument("output", help="summary table (.csv or .json)")
+    parser.add_argument("--workers", type=int, default=4, help="worker processes")
+    parser.add_argument("--per-host", type=int, default=2, help="concurrent requests allowed per Nightscout server, across its patients")
+    parser.add_argument("--cache", action="store_true", help="use the on-disk Nightscout cache")
+    parser.add_argument("--rate", type=float, default=dataretriever.REQUESTS_PER_SECOND,
+                        help="requests per second allowed per Nightscout server, across all workers")
+    args = parser.parse_args()
+
+    rows = read_manifest(args.manifest)
+    summaries = run_cohort(rows, args.workers, args.per_host, args.cache, args.rate)
+    write_summary(summaries, args.output)
+    print(f"Wrote {len(rows)} rows to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+from datetime import datetime, timedelta, timezone
+import numpy as np
+import instrumentation
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+MS_PER_HOUR = 3_600_000
+
+
+def epoch_ms(times) -> np.ndarray:
+    """Convert an iterable of aware datetimes to an int64 array of epoch milliseconds."""
+    times = list(times)
+    return np.fromiter(((t - EPOCH) // timedelta(milliseconds=1) for t in times), dtype=np.int64, count=len(times))
+
+
+def basal_arrays(basaldic: dict):
+    """Scheduled basal changes from basalinsulin.basaltimes -> (times_ms, rates), sorted by time."""
+    times = sorted(basaldic)
+    rates = np.fromiter((basaldic[t] for t in times), dtype=np.float64, count=len(times))
+    return epoch_ms(times), rates
+
+
+def temp_arrays(tempdic):
+    """Temp basals from treatmentinsulin.treatmenttimes -> (starts_ms, ends_ms, rates), sorted by start."""
+    if hasattr(tempdic, "arrays"):
+        # records.TempBasals already holds the columns
+        return tempdic.arrays()
+    starts = sorted(tempdic)
+    start_ms = epoch_ms(starts)
+    duration_ms = np.fromiter((tempdic[t]['duration'] for t in starts), dtype=np.float64, count=len(starts)) * 60_000
+    rates = np.fromiter((tempdic[t]['rate'] for t in starts), dtype=np.float64, count=len(starts))
+    return start_ms, start_ms + duration_ms.astype(np.int64), rates
+
+
+def bolus_arrays(bolusdic):
+    """Boluses from treatmentinsulin.treatmenttimes -> (times_ms, units)."""
+    if hasattr(bolusdic, "arrays"):
+        return bolusdic.arrays()
+    times = list(bolusdic)
+    units = np.fromiter((float(bolusdic[t]) for t in times), dtype=np.float64, count=len(times))
+    return epoch_ms(times), units
+
+
+def active_temp_index(starts, ends, times):
+    """
+    Index of the temp basal running at each of `times`, or -1 if none.
+    Where temps overlap the most recently started one wins, matching find_active_temp_basal.
+    """
+    active = np.full(len(times), -1, dtype=np.int64)
+    if len(starts) == 0:
+        return active
+    latest_end = np.maximum.accumulate(ends)
+    candidate = np.searchsorted(starts, times, side='right') - 1
+    # Only keep walking back while some earlier temp still runs past the query time
+    pending = candidate >= 0
+    pending[pending] = latest_end[candidate[pending]] > times[pending]
+    while pending.any():
+        idx = candidate[pending]
+        hit = ends[idx] > times[pending]
+        rows = np.flatnonzero(pending)
+        active[rows[hit]] = idx[hit]
+        candidate[rows] -= 1
+        still = rows[~hit]
+        still = still[candidate[still] >= 0]
+        pending[:] = False
+        pending[still] = latest_end[candidate[still]] > times[still]
+    return active
+
+
+def basal_segments(profile_ms, profile_rates, temp_start_ms, temp_end_ms, temp_rates, start: int, end: int,
+                   boundaries) -> tuple:
+    """
+    The basal rate between epoch ms `start` and `end` as constant segments (seg_start, seg_end, rates),
+    also split at every one of `boundaries`.
+    """
+    breaks = np.concatenate([[start, end], profile_ms, temp_start_ms, temp_end_ms, boundaries])
+    breaks = np.unique(breaks[(breaks >= start) & (breaks <= end)])
+    seg_start = breaks[:-1]
+    seg_end = breaks[1:]
+
+    # Scheduled rate, overridden wherever a temp basal is running
+    profile_index = np.searchsorted(profile_ms, seg_start, side='right') - 1
+    if (profile_index < 0).any():
+        missing = datetime.fromtimestamp(seg_start[profile_index < 0][0] / 1000, tz=timezone.utc)
+        raise ValueError(f"No basal profile active at {missing}")
+    rates = profile_rates[profile_index] if len(seg_start) else np.empty(0)
+    temp_index = active_temp_index(temp_start_ms, temp_end_ms, seg_start)
+    running = temp_index >= 0
+    rates = np.where(running, temp_rates[np.where(running, temp_index, 0)] if len(temp_rates) else 0.0, rates)
+    return seg_start, seg_end, rates
+
+
+def columnar_insulin_delivery(basaldic, tempdic, bolusdic, start_time: datetime, end_time: datetime,
+                              interval_minutes: int = 60, as_dict: bool = False):
+    """
+    Array-based equivalent of calculate_insulin_delivery.
+
+    Returns (basal, bolus, delivery) where delivery is a DataFrame indexed by the (UTC) end of each
+    interval with 'basal', 'bolus' and 'percent' columns, or the hourly-style dict when as_dict=True.
+    """
+    if hasattr(basaldic, "todict"):
+        # compiled BasalSchedule: only expand the window being integrated
+        basaldic = basaldic.todict(start_time, end_time)
+    profile_ms, profile_rates = basal_arrays(basaldic)
+    temp_start_ms, temp_end_ms, temp_rates = temp_arrays(tempdic)
+    bolus_ms, bolus_units = bolus_arrays(bolusdic)
+
+    start = (start_time - EPOCH) // timedelta(milliseconds=1)
+    end = (end_time - EPOCH) // timedelta(milliseconds=1)
+    interval = interval_minutes * 60_000
+
+    # Interval buckets are aligned to the epoch and labelled by their right edge
+    first_bucket = start // interval * interval
+    n_buckets = max(-(-(end - first_bucket) // interval), 0)
+    boundaries = first_bucket + interval * np.arange(1, n_buckets, dtype=np.int64)
+
+    seg_start, seg_end, rates = basal_segments(profile_ms, profile_rates, temp_start_ms, temp_end_ms, temp_rates,
+                                               start, end, boundaries)
+    instrumentation.count("columnar.segments", len(seg_start))
+
+    basal_units = rates * (seg_end - seg_start) / MS_PER_HOUR
+    basal_per_bucket = np.zeros(n_buckets)
+    np.add.at(basal_per_bucket, (seg_start - first_bucket) // interval, basal_units)
+
+    in_window = (bolus_ms >= start) & (bolus_ms < end)
+    bolus_per_bucket = np.zeros(n_buckets)
+    np.add.at(bolus_per_bucket, (bolus_ms[in_window] - first_bucket) // interval, bolus_units[in_window])
+
+    basal_insulin = float(basal_units.sum())
+    bolus_insulin = float(bolus_units[in_window].sum())
+    total_insulin = basal_insulin + bolus_insulin
+    if total_insulin > 0:
+        percent = (basal_per_bucket + bolus_per_bucket) / total_insulin * 100
+    else:
+        percent = np.zeros(n_buckets)
+
+    labels = first_bucket + interval * np.arange(1, n_buckets + 1, dtype=np.int64)
+    if as_dict:
+        delivery = {
+            datetime.fromtimestamp(label / 1000, tz=timezone.utc): {'basal': basal, 'bolus': bolus, 'percent': pct}
+            for label, basal, bolus, pct in zip(labels.tolist(), basal_per_bucket.tolist(),
+                                                 bolus_per_bucket.tolist(), percent.tolist())
+        }
+        return basal_insulin, bolus_insulin, delivery
+
+    # pandas is only loaded when the DataFrame is asked for
+    import pandas as pd
+    delivery = pd.DataFrame(
+        {'basal': basal_per_bucket, 'bolus': bolus_per_bucket, 'percent': percent},
+        index=pd.to_datetime(labels, unit='ms', utc=True),
+    )
+    return basal_insulin, bolus_insulin, delivery
@@ -1,10 +1,458 @@
 from urlformater import *
 import time
-from datetime import datetime, timedelta
-from urllib.request import urlopen
+from datetime import datetime, timedelta, timezone
 from urllib.error import URLError, HTTPError
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from collections import deque
+import http.client
+import sys
+import threading
+import queue
 import json
+import random
+import zlib
+from email.utils import parsedate_to_datetime
 from timecleaner import *
+import instrumentation
+
+# Upper bound on simultaneous requests to any one Nightscout host
+MAX_CONNECTIONS_PER_HOST = 4
+# Bytes read from the socket at a time when inflating a gzip response
+READ_CHUNK = 64 * 1024
+# Default request rate per host (requests/s) and burst allowance
+REQUESTS_PER_SECOND = 10
+REQUEST_BURST = 20
+# Longest backoff between retries of one request, in seconds
+MAX_BACKOFF = 60
+# How far (ms) records may arrive out of timestamp order and still be recognised as repeats
+DEDUP_WINDOW_MS = 60_000
+# Batches of SHARD_BATCH records each slice of shardedFetcher may hold before it waits for the merge
+SHARD_BUFFER = 4
+SHARD_BATCH = 1000
+# Uploader bookkeeping that differs between copies of the same record
+VOLATILE_FIELDS = frozenset(("_id", "identifier", "NSCLIENT_ID", "enteredBy", "utcOffset", "srvModified",
+                             "srvCreated"))
+
+class ConnectionPool:
+    """Thread-safe pool of keep-alive HTTP(S) connections with a per-host concurrency limit."""
+
+    def __init__(self, max_per_host: int = MAX_CONNECTIONS_PER_HOST, timeout: int = 60, compress: bool = True):
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self.headers = {"Accept": "application/json"}
+        if compress:
+            self.headers["Accept-Encoding"] = "gzip"
+        self._idle = {}     # (scheme, netloc) -> idle connections
+        self._limits = {}   # netloc -> semaphore bounding in-flight requests
+        self._lock = threading.Lock()
+
+    def limit(self, netloc: str):
+        with self._lock:
+            if netloc not in self._limits:
+                self._limits[netloc] = threading.BoundedSemaphore(self.max_per_host)
+            return self._limits[netloc]
+
+    def setLimit(self, netloc: str, semaphore):
+        """Use an external semaphore (e.g. one shared between processes) to bound requests to netloc."""
+        with self._lock:
+            self._limits[netloc] = semaphore
+
+    def _checkout(self, scheme: str, netloc: str):
+        with self._lock:
+            idle = self._idle.get((scheme, netloc))
+            if idle:
+                return idle.pop()
+        connection = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+        return connection(netloc, timeout=self.timeout)
+
+    def _checkin(self, scheme: str, netloc: str, conn):
+        with self._lock:
+            self._idle.setdefault((scheme, netloc), []).append(conn)
+
+    @contextmanager
+    def urlopen(self, url: str):
+        """Like urllib's urlopen, but reuses an idle connection to the host when one is available."""
+        parts = urlsplit(url)
+        path = parts.path + ("?" + parts.query if parts.query else "")
+        with self.limit(parts.netloc):
+            conn = self._checkout(parts.scheme, parts.netloc)
+            try:
+                conn.request("GET", path, headers=self.headers)
+                resp = conn.getresponse()
+            except (http.client.HTTPException, OSError) as e:
+                # a stale keep-alive socket surfaces here; let the caller's retry loop handle it
+                conn.close()
+                raise URLError(e)
+
+            if resp.status >= 400:
+                resp.read()
+                self._checkin(parts.scheme, parts.netloc, conn)
+                raise HTTPError(url, resp.status, resp.reason, resp.headers, None)
+
+            try:
+                yield resp
+            finally:
+                if resp.isclosed() and not resp.will_close:
+                    self._checkin(parts.scheme, parts.netloc, conn)
+                else:
+                    conn.close()
+
+    def close(self):
+        with self._lock:
+            for idle in self._idle.values():
+                for conn in idle:
+                    conn.close()
+            self._idle.clear()
+
+# Shared by every fetch in the process so connections survive across pages and collections
+POOL = ConnectionPool()
+
+class TokenBucket:
+    """`rate` requests per second with bursts of up to `burst`; waiting for a token only blocks the caller."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._stamp = time.monotonic()
+        self._pausedUntil = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+                self._stamp = now
+                if now >= self._pausedUntil and self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = max(self._pausedUntil - now, (1 - self._tokens) / self.rate)
+            time.sleep(wait)
+
+    def pause(self, seconds: float):
+        """Hold every request to the host for `seconds` (e.g. after a Retry-After)."""
+        with self._lock:
+            self._pausedUntil = max(self._pausedUntil, time.monotonic() + seconds)
+
+class RetryBudget:
+    """
+    Retries shared by all requests: up to `burst` at once, refilled by `ratio` per successful request,
+    so a failing host costs a bounded number of extra requests instead of max_retries for each one.
+    """
+
+    def __init__(self, ratio: float = 0.2, burst: int = 10):
+        self.ratio = ratio
+        self.burst = burst
+        self._tokens = float(burst)
+        self._lock = threading.Lock()
+
+    def success(self):
+        with self._lock:
+            self._tokens = min(self.burst, self._tokens + self.ratio)
+
+    def spend(self) -> bool:
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+def retryAfter(error) -> float:
+    """Seconds a 429/503 asked us to wait, or 0."""
+    value = getattr(error, "headers", None) and error.headers.get("Retry-After")
+    if not value:
+        return 0.0
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        try:
+            return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0.0)
+        except (TypeError, ValueError):
+            return 0.0
+
+def retryable(error) -> bool:
+    # client errors other than rate limiting won't go away by asking again
+    return not isinstance(error, HTTPError) or error.code == 429 or error.code >= 500
+
+class FetchScheduler:
+    """
+    Per-host token-bucket rate limits, jittered exponential backoff that honours Retry-After, a
+    global RetryBudget, and page sizes that adapt to how long pages take to come back.
+    """
+
+    def __init__(self, rate: float = REQUESTS_PER_SECOND, burst: float = REQUEST_BURST, *,
+                 budget: RetryBudget = None, max_backoff: float = MAX_BACKOFF, adaptive_pages: bool = True,
+                 target_seconds: float = 2.0, min_page: int = 100, max_page: int = 10000):
+        self.rate = rate
+        self.burst = burst
+        self.budget = budget or RetryBudget()
+        self.max_backoff = max_backoff
+        self.adaptive_pages = adaptive_pages
+        self.target_seconds = target_seconds
+        self.min_page = min_page
+        self.max_page = max_page
+        self._buckets = {}
+        self._pageSizes = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()  # latency of the calling thread's last successful request
+
+    def bucket(self, netloc: str) -> TokenBucket:
+        with self._lock:
+            if netloc not in self._buckets:
+                self._buckets[netloc] = TokenBucket(self.rate, self.burst)
+            return self._buckets[netloc]
+
+    def setRate(self, netloc: str, rate: float, burst: float = None):
+        with self._lock:
+            self._buckets[netloc] = TokenBucket(rate, burst or max(rate, 1))
+
+    def setBucket(self, netloc: str, bucket: TokenBucket):
+        """Rate-limit netloc with `bucket`, e.g. one shared by every patient subdomain of a server."""
+        with self._lock:
+            self._buckets[netloc] = bucket
+
+    def retryDelay(self, netloc: str, attempt: int, base_backoff: float, error):
+        """Seconds to wait before retrying `error`, or None when it shouldn't be retried."""
+        if not retryable(error) or not self.budget.spend():
+            return None
+        wait = random.uniform(0.5, 1.0) * min(self.max_backoff, base_backoff ** attempt)
+        server_wait = retryAfter(error)
+        if server_wait:
+            # the whole host is throttled, not just this request
+            self.bucket(netloc).pause(server_wait)
+            wait = max(wait, server_wait)
+        return wait
+
+    def recordLatency(self, seconds: float):
+        self._local.latency = seconds
+
+    def lastLatency(self) -> float:
+        return getattr(self._local, "latency", 0.0)
+
+    def pageSize(self, netloc: str, requested: int) -> int:
+        if not self.adaptive_pages:
+            return requested
+        with self._lock:
+            return self._pageSizes.get(netloc, requested)
+
+    def observePage(self, netloc: str, size: int, records: int, seconds: float):
+        """Halve the host's page size when pages are slow; double it while full pages come back quickly."""
+        if not self.adaptive_pages:
+            return
+        if seconds > self.target_seconds:
+            size = max(self.min_page, size // 2)
+        elif seconds < self.target_seconds / 4 and records >= size:
+            size = min(self.max_page, size * 2)
+        with self._lock:
+            self._pageSizes[netloc] = size
+
+# Rate limits, retry budget and page sizes shared by every fetch in the process
+SCHEDULER = FetchScheduler()
+
+def readBody(resp) -> bytes:
+    """
+    The response body. A gzipped body is inflated chunk by chunk as it is read, so the compressed
+    response is never held whole next to the inflated one; the inflated page is still held in full
+    for json.loads.
+    """
+    if (resp.getheader("Content-Encoding") or "").lower() != "gzip":
+        body = resp.read()
+        instrumentation.count("http.bytes", len(body))
+        return body
+    inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    parts = []
+    while chunk := resp.read(READ_CHUNK):
+        instrumentation.count("http.bytes", len(chunk))
+        parts.append(inflater.decompress(chunk))
+    parts.append(inflater.flush())
+    body = b"".join(parts)
+    instrumentation.count("http.bytes_inflated", len(body))
+    return body
+
+def fetchJSON(builtURL: str, *, max_retries: int = 3, base_backoff: int = 4, pool: ConnectionPool = POOL,
+              scheduler: FetchScheduler = None):
+    scheduler = scheduler or SCHEDULER
+    netloc = urlsplit(builtURL).netloc
+    for attempt in range(max_retries):
+        scheduler.bucket(netloc).acquire()
+        try:
+            began = time.monotonic()
+            with instrumentation.stage("http.request"), pool.urlopen(builtURL) as resp:
+                body = readBody(resp)
+            scheduler.recordLatency(time.monotonic() - began)
+            instrumentation.count("http.requests")
+            scheduler.budget.success()
+            return json.loads(body)
+        except (URLError, HTTPError, TimeoutError) as e:
+            instrumentation.count("http.errors")
+            wait = scheduler.retryDelay(netloc, attempt, base_backoff, e) if attempt < max_retries - 1 else None
+            if wait is None:
+                # exhausted retries or budget, or not worth retrying → re‑raise
+                raise
+            instrumentation.count("http.retries")
+            # stderr, so `localmain.py --json` output stays parseable
+            print(f"{e} — retrying in {wait:.1f}s …", file=sys.stderr)
+            # only this thread sleeps; other requests keep going
+            time.sleep(wait)
+
+class DedupIndex:
+    """
+    Exactly-once filter for records arriving newest first.
+
+    A record is a repeat if its _id was already seen, or if its content apart from VOLATILE_FIELDS
+    matches a record already seen at the same millisecond (the same treatment posted twice by an
+    uploader). Records arrive in timestamp order, so keys older than DEDUP_WINDOW_MS behind the
+    newest arrival are forgotten, and memory stays at about a minute of records for any range.
+    """
+
+    def __init__(self, field: str, window_ms: int = DEDUP_WINDOW_MS):
+        self.field = field
+        self.window = window_ms
+        # timestamps are compared as milliseconds, whatever their format
+        self._skip = VOLATILE_FIELDS | {field} | set(NUMERIC_FIELDS)
+        self._keys = set()
+        self._order = deque()  # (ms, id key, content key) in arrival order
+
+    def _ms(self, record: dict):
+        try:
+            return record_ms(record, self.field)
+        except (KeyError, TypeError, ValueError):
+            return self._order[-1][0] if self._order else 0
+
+    def content(self, record: dict, ms: int):
+        skip = self._skip
+        try:
+            items = frozenset([item for item in record.items() if item[0] not in skip])
+        except TypeError:
+            # nested values (profile stores)
+            items = json.dumps({key: value for key, value in record.items() if key not in skip}, sort_keys=True)
+        return ms, items
+
+    def fresh(self, record: dict) -> bool:
+        """True the first time a record is offered, False for repeats."""
+        ms = self._ms(record)
+        while self._order and self._order[0][0] > ms + self.window:
+            _, idKey, contentKey = self._order.popleft()
+            self._keys.discard(idKey)
+            self._keys.discard(contentKey)
+        idKey = ("_id", record["_id"]) if record.get("_id") is not None else None
+        contentKey = self.content(record, ms)
+        if (idKey is not None and idKey in self._keys) or contentKey in self._keys:
+            return False
+        self._keys.add(contentKey)
+        if idKey is not None:
+            self._keys.add(idKey)
+        self._order.append((ms, idKey, contentKey))
+        return True
+
+    def filter(self, records):
+        return [record for record in records if self.fresh(record)]
+
+def uniqueRecords(records, type: str):
+    """Yield each record of a newest-first stream once (see DedupIndex)."""
+    index = DedupIndex(timestampvariable(type))
+    for record in records:
+        if index.fresh(record):
+            yield record
+        else:
+            instrumentation.count("duplicates." + type)
+
+def pageFetcher(
+        ptID: str,
+        type: str,
+        startDate: str,
+        endDate: str,
+        *,
+        page_size: int = PAGE_SIZE,
+        max_retries: int = 3,
+        base_backoff: int = 4,  # 2 s, 4 s, 8 s …
+        pool: ConnectionPool = POOL,
+        scheduler: FetchScheduler = None,
+):
+    """
+    Yield Nightscout pages (newest first) one at a time, walking endDate backwards.
+    page_size is where the scheduler's adaptive page size for the host starts.
+
+    Each page ends where the next one starts: the next query runs up to and including the exact
+    timestamp of the oldest record received, so records sharing it across the page boundary are
+    kept, and the ones already yielded are dropped by a DedupIndex along with uploader duplicates.
+    """
+    timestamp = timestampvariable(type)
+    scheduler = scheduler or SCHEDULER
+    netloc = urlsplit(baseurl(ptID)).netloc
+    index = DedupIndex(timestamp)
+    inclusive = True
+
+    while True:
+        size = scheduler.pageSize(netloc, page_size)
+        builtURL = urlformater(ptID, type, startDate, endDate, count=size, inclusive=inclusive)
+        data = fetchJSON(builtURL, max_retries=max_retries, base_backoff=base_backoff, pool=pool, scheduler=scheduler)
+        # rate-limit waits and retries don't count, only how long the server took
+        scheduler.observePage(netloc, size, len(data or ()), scheduler.lastLatency())
+        if not data:
+            return
+        instrumentation.count("pages." + type)
+        instrumentation.count("records." + type, len(data))
+        fresh = index.filter(data)
+        instrumentation.count("duplicates." + type, len(data) - len(fresh))
+        if fresh:
+            yield fresh
+
+        # a short page means the range is exhausted
+        if len(data) < size:
+            return
+        cursor = data[-1][timestamp]
+        inclusive = cursor != endDate
+        if not inclusive:
+            # the whole page shares the cursor's timestamp: take every record stamped with it at
+            # once, then carry on strictly before it
+            count = size
+            while len(data) >= count:
+                count *= 2
+                data = fetchJSON(urlformater(ptID, type, cursor, cursor, count=count), max_retries=max_retries,
+                                 base_backoff=base_backoff, pool=pool, scheduler=scheduler)
+            fresh = index.filter(data)
+            instrumentation.count("duplicates." + type, len(data) - len(fresh))
+            if fresh:
+                yield fresh
+        endDate = cursor
+
+# Optional responsecache.ResponseCache consulted by recordFetcher/dataFetcher, see useCache
+CACHE = None
+
+def useCache(cache):
+    """Route every record fetch through `cache` (a responsecache.ResponseCache), or None to disable."""
+    global CACHE
+    CACHE = cache
+
+# Optional datasource.DataSource every fetch is served from instead of the network, see useSource
+SOURCE = None
+
+def useSource(source):
+    """Serve recordFetcher/dataFetcher/newestBefore from `source` (e.g. a datasource.FileSource), or None for HTTP."""
+    global SOURCE
+    SOURCE = source
+
+def recordFetcher(ptID: str, type: str, startDate: str, endDate: str, **options):
+    """Yield Nightscout records one at a time; only one page is held in memory."""
+    if SOURCE is not None:
+        yield from uniqueRecords(SOURCE.records(ptID, type, startDate, endDate, **options), type)
+        return
+    yield from httpRecords(ptID, type, startDate, endDate, **options)
+
+def httpRecords(ptID: str, type: str, startDate: str, endDate: str, **options):
+    """recordFetcher over the Nightscout API, through the cache when one is in use."""
+    if CACHE is not None:
+        # pages are de-duplicated before they are stored, but separately fetched gaps may still overlap
+        yield from uniqueRecords(CACHE.records(ptID, type, startDate, endDate,
+                                               lambda gapStart, gapEnd: pageFetcher(ptID, type, gapStart, gapEnd,
+                                                                                    **options)), type)
+        return
+    for page in pageFetcher(ptID, type, startDate, endDate, **options):
+        yield from page
 
 def dataFetcher(
         ptID: str,
@@ -13,36 +461,91 @@ def dataFetcher(
         endDate: str,
         result=None,
         *,
+        page_size: int = PAGE_SIZE,
         max_retries: int = 3,
-        base_backoff: int = 4,  # 2 s, 4 s, 8 s …
+        base_backoff: int = 4,  # 2 s, 4 s, 8 s …
 ):
     if result is None:
         result = []
 
-    timestamp = timestampvariable(type)
-    builtURL = urlformater(ptID, type, startDate, endDate)
+    result.extend(recordFetcher(ptID, type, startDate, endDate, page_size=page_size,
+                                max_retries=max_retries, base_backoff=base_backoff))
+    return result
 
-    for attempt in range(max_retries):
+def newestBefore(ptID: str, type: str, endDate: str, count: int = 1, **options) -> list:
+    """The `count` newest records at or before endDate, in one request."""
+    if SOURCE is not None:
+        return SOURCE.newest_before(ptID, type, endDate, count)
+    return httpNewestBefore(ptID, type, endDate, count, **options)
+
+def httpNewestBefore(ptID: str, type: str, endDate: str, count: int = 1, *,
+                     max_retries: int = 3, base_backoff: int = 4, pool: ConnectionPool = POOL) -> list:
+    builtURL = urlformater(ptID, type, None, endDate, count=count)
+    return fetchJSON(builtURL, max_retries=max_retries, base_backoff=base_backoff, pool=pool)
+
+def shardedFetcher(ptID: str, type: str, startDate: str, endDate: str, shards: int = 4, **options):
+    """
+    Yield the records of [startDate, endDate] newest first, fetching `shards` time slices in parallel.
+    Neighbouring slices share their boundary second, so records seen twice are dropped by a DedupIndex.
+
+    Each slice streams through recordFetcher into a queue of at most SHARD_BUFFER batches, so a slice
+    that is ahead of the one being yielded waits for it instead of piling up its whole range.
+    """
+    start = datetime.fromisoformat(startDate)
+    end = datetime.fromisoformat(endDate)
+    step = (end - start) / shards
+    bounds = [(start + step * i).isoformat(timespec="seconds") for i in range(shards)] + [endDate]
+    # newest slice first so the merged output keeps Nightscout's descending order
+    slices = [(bounds[i], bounds[i + 1]) for i in reversed(range(shards))]
+    queues = [queue.Queue(maxsize=SHARD_BUFFER) for _ in slices]
+    stopped = threading.Event()
+
+    def put(out: queue.Queue, item) -> bool:
+        while not stopped.is_set():
+            try:
+                out.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def fill(out: queue.Queue, lo: str, hi: str):
         try:
-            with urlopen(builtURL, timeout=60) as resp:
-                data = json.load(resp)
-            # success ⇒ break the retry‑loop
-            break
-        except (URLError, HTTPError, TimeoutError) as e:
-            if attempt < max_retries - 1:
-                wait = base_backoff ** attempt
-                print(f"{e} — retrying in {wait}s …")
-                time.sleep(wait)
-                continue
-            else:
-                # exhausted retries → re‑raise (or return None / log, etc.)
-                raise
+            batch = []
+            for record in recordFetcher(ptID, type, lo, hi, **options):
+                batch.append(record)
+                if len(batch) >= SHARD_BATCH:
+                    if not put(out, batch):
+                        return
+                    batch = []
+            if put(out, batch):
+                put(out, None)
+        except Exception as e:
+            put(out, e)
+
+    def merged():
+        for out in queues:
+            while (batch := out.get()) is not None:
+                if isinstance(batch, Exception):
+                    raise batch
+                yield from batch
+
+    with ThreadPoolExecutor(max_workers=shards) as executor:
+        for out, (lo, hi) in zip(queues, slices):
+            executor.submit(instrumentation.carried(fill), out, lo, hi)
+        try:
+            yield from uniqueRecords(merged(), type)
+        finally:
+            # an abandoned or failed merge lets the slices still downloading stop after their page
+            stopped.set()
 
-    if data:
-        result += data
-        lastdtstring = timeclean(data[-1][timestamp])
-        nexttime = (datetime.fromisoformat(lastdtstring) - timedelta(seconds=1))
-        nextendDate = nexttime.isoformat()
-        dataFetcher(ptID, type, startDate, nextendDate, result,
-                    max_retries=max_retries, base_backoff=base_backoff)
-    return result
\ No newline at end of file
+def fetchConcurrently(tasks: dict, max_workers: int = None) -> dict:
+    """
+    Run independent downloads in parallel threads.
+    tasks is {name: (function, *args)}; returns {name: result} once all have finished.
+    """
+    with ThreadPoolExecutor(max_workers=max_workers or len(tasks)) as executor:
+        futures = {name: executor.submit(instrumentation.carried(instrumentation.timed("fetch." + name)(task[0])),
+                                         *task[1:])
+                   for name, task in tasks.items()}
+        return {name: future.result() for name, future in futures.items()}
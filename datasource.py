@@ -0,0 +1,239 @@
+"""
+Pluggable sources of Nightscout records.
+
+HTTPSource reads from the Nightscout API (the default path in dataretriever). FileSource replays
+local exports of entries, treatments and profiles, so the whole pipeline can run from disk:
+
+    dataretriever.useSource(FileSource("exports/"))           # exports/entries.ndjson, ...
+    dataretriever.useSource(FileSource({"profiles": "ptData/scrappy.json"}))
+
+Files can be JSON arrays (as the API returns them), NDJSON (one record per line) or CSV. They are
+memory-mapped; NDJSON is indexed by timestamp on first use so a range query only parses the records
+inside the range, and JSON arrays are decoded one record at a time with out-of-range records dropped.
+JSON and CSV files stream only once they are known to be newest first, like API exports: the first
+query of a file collects and sorts its matches and notes the order, and later queries of a newest-first
+file yield in file order and stop at the start of the range. Only NDJSON streams regardless of order.
+"""
+import codecs
+import csv
+import heapq
+import json
+import mmap
+import os
+import re
+import threading
+from abc import ABC, abstractmethod
+from bisect import bisect_left, bisect_right
+
+import dataretriever
+from urlformater import timestampvariable
+
+COLLECTIONS = ("entries", "treatments", "profiles")
+EXTENSIONS = (".ndjson", ".jsonl", ".json", ".csv")
+CHUNK_SIZE = 1 << 20
+
+
+class DataSource(ABC):
+    """Interface: records come back newest first, filtered with Nightscout's string range semantics."""
+
+    @abstractmethod
+    def records(self, ptID: str, type: str, startDate: str, endDate: str, **options):
+        ...
+
+    @abstractmethod
+    def newest_before(self, ptID: str, type: str, endDate: str, count: int = 1) -> list:
+        ...
+
+
+class HTTPSource(DataSource):
+    """The Nightscout API, with dataretriever's paging, retries and cache."""
+
+    def __init__(self, **options):
+        self.options = options
+
+    def records(self, ptID, type, startDate, endDate, **options):
+        return dataretriever.httpRecords(ptID, type, startDate, endDate, **{**self.options, **options})
+
+    def newest_before(self, ptID, type, endDate, count=1):
+        return dataretriever.httpNewestBefore(ptID, type, endDate, count)
+
+
+def coerce(value: str):
+    # CSV cells are strings; restore the JSON types the parsers expect
+    if value == "":
+        return None
+    if value[0] in "[{":
+        try:
+            return json.loads(value)
+        except ValueError:
+            return value
+    for cast in (int, float):
+        try:
+            return cast(value)
+        except ValueError:
+            pass
+    return value
+
+
+def iter_json_array(mm, chunk_size: int = CHUNK_SIZE):
+    """Decode a memory-mapped JSON array one element at a time, holding about one chunk of text."""
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder("utf-8")()
+    buffer, pos, offset = "", 0, 0
+    started = False
+
+    def refill():
+        nonlocal buffer, pos, offset
+        if offset >= len(mm):
+            return False
+        buffer = buffer[pos:] + text.decode(mm[offset:offset + chunk_size], final=offset + chunk_size >= len(mm))
+        pos = 0
+        offset += chunk_size
+        return True
+
+    while True:
+        while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+            pos += 1
+        if pos >= len(buffer):
+            if not refill():
+                return
+            continue
+        if not started:
+            if buffer[pos] != "[":
+                raise ValueError("Expected a JSON array")
+            started = True
+            pos += 1
+            continue
+        if buffer[pos] == "]":
+            return
+        try:
+            record, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            # the element runs past the decoded text
+            if not refill():
+                raise
+            continue
+        yield record
+        pos = end
+
+
+class FileSource(DataSource):
+    def __init__(self, paths):
+        """
+        paths is a directory holding <collection>.{ndjson,jsonl,json,csv} files (optionally inside a
+        per-NSID subdirectory) or a {collection: file} mapping.
+        """
+        self.paths = paths
+        self._indexes = {}  # NDJSON path -> (timestamps, spans, mmap)
+        self._descending = {}  # JSON/CSV path -> whether its records are newest first
+        self._lock = threading.Lock()
+
+    def path(self, ptID: str, type: str):
+        if isinstance(self.paths, dict):
+            return self.paths.get(type)
+        for directory in (os.path.join(self.paths, ptID), self.paths):
+            for extension in EXTENSIONS:
+                candidate = os.path.join(directory, type + extension)
+                if os.path.exists(candidate):
+                    return candidate
+        return None
+
+    def records(self, ptID, type, startDate, endDate, **options):
+        path = self.path(ptID, type)
+        if path is None:
+            return iter(())
+        field = timestampvariable(type)
+        if path.endswith((".ndjson", ".jsonl")):
+            return self._indexed(path, field, startDate, endDate)
+        return self._ranged(path, field, startDate, endDate)
+
+    def newest_before(self, ptID, type, endDate, count=1):
+        path = self.path(ptID, type)
+        if path is None:
+            return []
+        field = timestampvariable(type)
+        if path.endswith((".ndjson", ".jsonl")):
+            return list(self._indexed(path, field, None, endDate, count))
+        candidates = (record for record in self._scan(path) if str(record.get(field, "")) <= endDate)
+        return heapq.nlargest(count, candidates, key=lambda record: record[field])
+
+    def _scan(self, path):
+        """Every record of a JSON array or CSV file, decoded lazily."""
+        if path.endswith(".csv"):
+            with open(path, newline="") as f:
+                for row in csv.DictReader(f):
+                    yield {key: coerce(value) for key, value in row.items()}
+            return
+        if os.path.getsize(path) == 0:
+            return
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            yield from iter_json_array(mm)
+
+    def _ranged(self, path, field, startDate, endDate):
+        if self._descending.get(path):
+            for record in self._scan(path):
+                timestamp = str(record.get(field, ""))
+                if timestamp < startDate:
+                    return
+                if timestamp <= endDate:
+                    yield record
+            return
+        matching, descending, previous = [], True, None
+        for record in self._scan(path):
+            timestamp = str(record.get(field, ""))
+            if previous is not None and timestamp > previous:
+                descending = False
+            previous = timestamp
+            if startDate <= timestamp <= endDate:
+                matching.append(record)
+        with self._lock:
+            self._descending[path] = descending
+        if not descending:
+            matching.sort(key=lambda record: record[field], reverse=True)
+        yield from matching
+
+    def _indexed(self, path, field, startDate, endDate, limit=None):
+        timestamps, spans, mm = self._index(path, field)
+        lo = 0 if startDate is None else bisect_left(timestamps, startDate)
+        hi = bisect_right(timestamps, endDate)
+        if limit is not None:
+            lo = max(lo, hi - limit)
+        for index in range(hi - 1, lo - 1, -1):
+            start, end = spans[index]
+            yield json.loads(mm[start:end])
+
+    def _index(self, path, field):
+        # one pass over the mapped file reading only the timestamp of each line
+        with self._lock:
+            if path in self._indexes:
+                return self._indexes[path]
+            with open(path, "rb") as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(path) else b""
+            pattern = re.compile(rb'"' + re.escape(field.encode()) + rb'"\s*:\s*"([^"]*)"')
+            entries = []
+            start = 0
+            while start < len(mm):
+                end = mm.find(b"\n", start)
+                end = len(mm) if end == -1 else end
+                match = pattern.search(mm, start, end)
+                if match:
+                    entries.append((match.group(1).decode(), start, end))
+                start = end + 1
+            entries.sort()
+            index = ([timestamp for timestamp, _, _ in entries], [(start, end) for _, start, end in entries], mm)
+            self._indexes[path] = index
+            return index
+
+    def close(self):
+        with self._lock:
+            for _, _, mm in self._indexes.values():
+                if isinstance(mm, mmap.mmap):
+                    mm.close()
+            self._indexes.clear()
+
+
+def export_ndjson(records, path: str):
+    """Write records as NDJSON, the format FileSource can range-query without a full scan."""
+    with open(path, "w") as f:
+        for record in records:
+            f.write(json.dumps(record, separators=(",", ":")) + "\n")
@@ -1,13 +1,12 @@
 from datetime import datetime
-import pandas as pd
-import matplotlib.pyplot as plt
+import instrumentation
 
 def average_glucose(glucose_data: dict, start_time: datetime, end_time: datetime) -> float:
     """
     Calculate the average glucose value between two datetime points (inclusive).
 
     Parameters:
-        glucose_data (dict): Dictionary of {datetime: glucose_value}
+        glucose_data (dict): Dictionary of {datetime: glucose_value}, or a records.GlucoseSeries
         start_time (datetime): Start time (inclusive)
         end_time (datetime): End time (inclusive)
 
@@ -17,6 +16,10 @@ def average_glucose(glucose_data: dict, start_time: datetime, end_time: datetime
     if start_time > end_time:
         start_time, end_time = end_time, start_time  # Ensure proper ordering
 
+    if hasattr(glucose_data, "mean"):
+        # records.GlucoseSeries answers from prefix sums
+        return glucose_data.mean(start_time, end_time)
+
     # Filter values between start_time and end_time (inclusive)
     values_in_range = [
         value for time, value in glucose_data.items()
@@ -29,21 +32,31 @@ def average_glucose(glucose_data: dict, start_time: datetime, end_time: datetime
     return sum(values_in_range) / len(values_in_range)
 
 
-def avg_glucose_plot(glucose_data: dict, start_datetime: datetime, end_datetime: datetime, minutes, tz):
-    # Convert to DataFrame
-    df = pd.DataFrame(list(glucose_data.items()), columns=['datetime', 'glucose'])
-    df.set_index('datetime', inplace=True)
+@instrumentation.timed("plot.avg_glucose")
+def avg_glucose_plot(glucose_data, start_datetime: datetime, end_datetime: datetime, minutes, tz):
+    # plotting libraries are only loaded once a plot is asked for
+    import pandas as pd
+    import matplotlib.pyplot as plt
+
+    if hasattr(glucose_data, "interval_means"):
+        # shared with any table built from the same series and window
+        resampled = glucose_data.interval_means(start_datetime, end_datetime, minutes).to_frame()
+        resampled.index = resampled.index.tz_convert(tz)
+    else:
+        # Convert to DataFrame
+        df = pd.DataFrame(list(glucose_data.items()), columns=['datetime', 'glucose'])
+        df.set_index('datetime', inplace=True)
 
-    # Convert timezone
-    df.index = df.index.tz_convert(tz)
+        # Convert timezone
+        df.index = df.index.tz_convert(tz)
 
-    df.sort_index(inplace=True)
+        df.sort_index(inplace=True)
 
-    # Filter to the selected datetime range
-    df = df.loc[start_datetime:end_datetime]
+        # Filter to the selected datetime range
+        df = df.loc[start_datetime:end_datetime]
 
-    # Resample to 30-minute intervals
-    resampled = df.resample(f"{minutes}T", label='right').mean()
+        # Resample to 30-minute intervals
+        resampled = df.resample(f"{minutes}min", label='right').mean()
 
     # Create plot
     fig, ax = plt.subplots(figsize=(10, 5))
@@ -1,23 +1,26 @@
 from dataretriever import *
-from datetime import timezone
+from records import GlucoseSeries
 
 
 def glucosedata(data):
     date = timestampvariable("entries")
-    # Select dates of glucose readings
-    sgv_dates = list([datetime.fromisoformat(timeclean(entry[date])).replace(tzinfo=timezone.utc) for entry in data if 'sgv' in entry])
-    # Select all glucose readings
-    sgv_values = list([entry['sgv'] for entry in data if 'sgv' in entry])
-    # Combine glucose, date readings into list
+    # Single pass over the records so a streaming fetcher can feed this directly
     sgv_values_dt = {}
-    for index, value in enumerate(sgv_values):
-        sgv_values_dt[sgv_dates[index]] = value/18.016 # convert to mmol/L
+    for entry in data:
+        if 'sgv' in entry:
+            sgv_date = record_datetime(entry, date)
+            sgv_values_dt[sgv_date] = entry['sgv']/18.016 # convert to mmol/L
+    instrumentation.count("parsed.entries", len(sgv_values_dt))
     return sgv_values_dt
 
-def glucosereadings(nsid, startdate, enddate):
-    outputdata = dataFetcher(nsid, "entries", startdate, enddate)
-    #[print(n) for n in outputdata]
+def glucosereadings(nsid, startdate, enddate, page_size=PAGE_SIZE, shards=1, compact=False):
+    """compact=True returns a records.GlucoseSeries instead of the {datetime: mmol/L} dict."""
+    if shards > 1:
+        outputdata = shardedFetcher(nsid, "entries", startdate, enddate, shards, page_size=page_size)
+    else:
+        outputdata = recordFetcher(nsid, "entries", startdate, enddate, page_size=page_size)
+    if compact:
+        return GlucoseSeries.from_records(outputdata)
     glucosedic = glucosedata(outputdata)
     #print(glucosedic)
     return glucosedic
-
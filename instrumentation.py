@@ -0,0 +1,148 @@
+"""
+Opt-in stage timing, counters and a structured run report.
+
+    with instrumentation.run(profile=True) as report:
+        ...
+    print(report.to_json())
+    print(report.profile_text())
+
+The pipeline calls stage("name") / @timed("name") around its stages and count("name", n) for
+requests, pages, retries, bytes, records and calculator loop iterations. Outside a run these
+return straight away, so the hooks stay in place permanently.
+
+The run is held in a context variable, so concurrent runs (e.g. two Streamlit sessions) each get
+their own report. Worker threads record into the run of the thread that started them when their
+function is wrapped with carried(). Stage times from parallel fetch threads are summed, so they can
+add up to more than the wall time. cProfile only sees the thread that started the run, and only one
+profiled run can be active in a process, so a server handling several sessions should leave it off.
+
+Inside `with listening(callback):` every count() made in that context (and in worker threads it
+starts through carried()) is also passed to callback(name, n), with or without a run, e.g. to show
+the progress of one download while it happens.
+"""
+import cProfile
+import contextvars
+import io
+import json
+import pstats
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from functools import partial, wraps
+
+# The run being recorded in the current context, or None
+REPORT = contextvars.ContextVar("instrumentation_report", default=None)
+# Callbacks given every count() in the current context, see listening()
+LISTENERS = contextvars.ContextVar("instrumentation_listeners", default=())
+
+
+class RunReport:
+    def __init__(self, profile: bool = False):
+        self.started = datetime.now(timezone.utc)
+        self.seconds = None
+        self.stages = {}  # name -> [calls, seconds]
+        self.counters = {}
+        self.profiler = cProfile.Profile() if profile else None
+        self._began = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def add_time(self, name: str, seconds: float):
+        with self._lock:
+            totals = self.stages.setdefault(name, [0, 0.0])
+            totals[0] += 1
+            totals[1] += seconds
+
+    def add(self, name: str, n=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            stages = sorted(self.stages.items(), key=lambda item: item[1][1], reverse=True)
+            return {
+                "started": self.started.isoformat(timespec="seconds"),
+                "seconds": self.seconds if self.seconds is not None else time.perf_counter() - self._began,
+                "stages": {name: {"calls": calls, "seconds": seconds} for name, (calls, seconds) in stages},
+                "counters": dict(sorted(self.counters.items())),
+            }
+
+    def to_json(self, indent: int = 2) -> str:
+        return json.dumps(self.as_dict(), indent=indent)
+
+    def profile_text(self, limit: int = 30, sort: str = "cumulative") -> str:
+        """The top of the cProfile statistics as text, or "" when the run wasn't profiled."""
+        if self.profiler is None:
+            return ""
+        out = io.StringIO()
+        pstats.Stats(self.profiler, stream=out).sort_stats(sort).print_stats(limit)
+        return out.getvalue()
+
+    def dump_profile(self, path: str):
+        """Write the cProfile data for pstats/snakeviz."""
+        self.profiler.dump_stats(path)
+
+
+@contextmanager
+def run(profile: bool = False):
+    """Record into a new RunReport until the block exits, however it exits."""
+    report = RunReport(profile)
+    token = REPORT.set(report)
+    if report.profiler is not None:
+        report.profiler.enable()
+    try:
+        yield report
+    finally:
+        if report.profiler is not None:
+            report.profiler.disable()
+        report.seconds = time.perf_counter() - report._began
+        REPORT.reset(token)
+
+
+def carried(function):
+    """function bound to a copy of the caller's context, to run on a worker thread within the caller's run."""
+    return partial(contextvars.copy_context().run, function)
+
+
+@contextmanager
+def stage(name: str):
+    report = REPORT.get()
+    if report is None:
+        yield
+        return
+    began = time.perf_counter()
+    try:
+        yield
+    finally:
+        report.add_time(name, time.perf_counter() - began)
+
+
+def timed(name: str):
+    """Decorator form of stage()."""
+    def decorate(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if REPORT.get() is None:
+                return function(*args, **kwargs)
+            with stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+@contextmanager
+def listening(callback):
+    """Call callback(name, n) from every count() in this context until the block exits."""
+    token = LISTENERS.set(LISTENERS.get() + (callback,))
+    try:
+        yield
+    finally:
+        LISTENERS.reset(token)
+
+
+def count(name: str, n=1):
+    report = REPORT.get()
+    if report is not None:
+        report.add(name, n)
+    for listener in LISTENERS.get():
+        listener(name, n)
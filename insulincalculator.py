@@ -1,11 +1,129 @@
 from datetime import datetime, timedelta
 from collections import defaultdict
-import pandas as pd
-import matplotlib.pyplot as plt
+from bisect import bisect_right
+import heapq
+import instrumentation
 
-def calculate_insulin_delivery(basalinsulin, tempdic, bolusdic, start_time, end_time):
+ENGINES = ("sweep", "columnar", "legacy")
+
+def calculate_insulin_delivery(basalinsulin, tempdic, bolusdic, start_time, end_time, engine="sweep", action=None):
+    """
+    Returns (basal, bolus, hourly_delivery) for the window [start_time, end_time).
+
+    engine="sweep" walks a pre-sorted event timeline once; engine="columnar" integrates with NumPy
+    arrays (see columnarcalculator); engine="legacy" is the original per-step search kept so the
+    outputs can be diffed. basalinsulin may be the {time: rate} dict or a compiled BasalSchedule,
+    which is only expanded over the requested window. tempdic/bolusdic may be the dicts from
+    treatmenttimes or the records.TempBasals/Boluses columns.
+
+    action="exponential" or "bilinear" also gives every hour 'iob' (units on board at its end) and
+    'activity' (mean units/hour acting), using the DIA of the profiles (see insulinaction).
+    """
+    with instrumentation.stage("delivery." + engine):
+        result = _calculate_insulin_delivery(basalinsulin, tempdic, bolusdic, start_time, end_time, engine)
+    if action:
+        from insulinaction import add_action
+        with instrumentation.stage("action." + action):
+            add_action(result[2], basalinsulin, tempdic, bolusdic, start_time, end_time, action)
+    return result
+
+
+def _calculate_insulin_delivery(basalinsulin, tempdic, bolusdic, start_time, end_time, engine):
+    if hasattr(basalinsulin, "todict"):
+        with instrumentation.stage("basalschedule.expand"):
+            basalinsulin = basalinsulin.todict(start_time, end_time)
+
+    if engine == "columnar":
+        from columnarcalculator import columnar_insulin_delivery
+        return columnar_insulin_delivery(basalinsulin, tempdic, bolusdic, start_time, end_time, as_dict=True)
+
+    if hasattr(tempdic, "todict"):
+        tempdic = tempdic.todict()
+    if hasattr(bolusdic, "todict"):
+        bolusdic = bolusdic.todict()
+
+    if engine == "sweep":
+        return sweep_insulin_delivery(basalinsulin, tempdic, bolusdic, start_time, end_time)
+    elif engine == "legacy":
+        return legacy_insulin_delivery(basalinsulin, tempdic, bolusdic, start_time, end_time)
+    else:
+        raise ValueError(f"Unknown engine {engine!r}, expected one of {ENGINES}")
+
+
+def sweep_insulin_delivery(basalinsulin, tempdic, bolusdic, start_time, end_time):
+    basal_insulin = 0
+    current_time = start_time
+
+    # Store per-hour delivery
+    hourly_delivery = defaultdict(lambda: {'basal': 0.0, 'bolus': 0.0})
+
+    # Sort profile changes and temp basal start/end events once
+    profile_times = sorted(basalinsulin)
+    temps = sorted((start, start + timedelta(minutes=details['duration']), details['rate'])
+                   for start, details in tempdic.items())
+    temp_starts = [temp[0] for temp in temps]
+    temp_ends = sorted(temp[1] for temp in temps)
+
+    def hour_boundaries():
+        next_hour = start_time.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
+        while next_hour < end_time:
+            yield next_hour
+            next_hour += timedelta(hours=1)
+
+    timeline = heapq.merge(profile_times, temp_starts, temp_ends, hour_boundaries(), [end_time])
+
+    profile_index = bisect_right(profile_times, start_time) - 1
+    temp_index = 0
+    active_temps = []  # heap of (-start, end, rate); the top is the most recently started temp
+    events = steps = 0
+
+    for next_significant_time in timeline:
+        events += 1
+        if next_significant_time <= current_time:
+            continue
+        steps += 1
+        next_significant_time = min(next_significant_time, end_time)
+
+        # Advance the profile pointer and the set of started temp basals up to current_time
+        while profile_index + 1 < len(profile_times) and profile_times[profile_index + 1] <= current_time:
+            profile_index += 1
+        while temp_index < len(temps) and temps[temp_index][0] <= current_time:
+            start, end, rate = temps[temp_index]
+            heapq.heappush(active_temps, (-start.timestamp(), end, rate))
+            temp_index += 1
+        while active_temps and active_temps[0][1] <= current_time:
+            heapq.heappop(active_temps)
+
+        if active_temps:
+            active_rate = active_temps[0][2]
+        elif profile_index >= 0:
+            active_rate = basalinsulin[profile_times[profile_index]]
+        else:
+            active_rate = None
+
+        # Duration in hours
+        duration_hr = (next_significant_time - current_time).total_seconds() / 3600
+        insulin_amount = active_rate * duration_hr
+        basal_insulin += insulin_amount
+
+        # Log it by hour
+        hour_key = (current_time.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1))
+        hourly_delivery[hour_key]['basal'] += insulin_amount
+
+        current_time = next_significant_time
+        if current_time >= end_time:
+            break
+
+    instrumentation.count("sweep.events", events)
+    instrumentation.count("sweep.steps", steps)
+    bolus_insulin = log_boluses(hourly_delivery, bolusdic, start_time, end_time)
+    add_percentages(hourly_delivery, basal_insulin + bolus_insulin)
+
+    return basal_insulin, bolus_insulin, dict(hourly_delivery)
+
+
+def legacy_insulin_delivery(basalinsulin, tempdic, bolusdic, start_time, end_time):
     basal_insulin = 0
-    bolus_insulin = 0
     current_time = start_time
 
     # Store per-hour delivery
@@ -14,7 +132,10 @@ def calculate_insulin_delivery(basalinsulin, tempdic, bolusdic, start_time, end_
     # Initial basal rate
     active_rate = find_active_rate_at_time(start_time, basalinsulin, tempdic)
 
+    steps = 0
+
     while current_time < end_time:
+        steps += 1
         # Determine next key event
         next_temp_basal_end = find_temp_basal_duration(current_time, tempdic)
         next_temp_basal_start = find_next_temp_basal_start(current_time, tempdic)
@@ -42,21 +163,29 @@ def calculate_insulin_delivery(basalinsulin, tempdic, bolusdic, start_time, end_
         current_time = next_significant_time
         active_rate = find_active_rate_at_time(current_time, basalinsulin, tempdic)
 
-    # Log boluses
+    instrumentation.count("legacy.steps", steps)
+    bolus_insulin = log_boluses(hourly_delivery, bolusdic, start_time, end_time)
+    add_percentages(hourly_delivery, basal_insulin + bolus_insulin)
+
+    return basal_insulin, bolus_insulin, dict(hourly_delivery)
+
+
+def log_boluses(hourly_delivery, bolusdic, start_time, end_time):
+    bolus_insulin = 0
     for bolus_time, bolus_amount in bolusdic.items():
         if start_time <= bolus_time < end_time:
             bolus_insulin += bolus_amount
             hour_key = (bolus_time.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1))
             hourly_delivery[hour_key]['bolus'] += bolus_amount
+    return bolus_insulin
+
 
+def add_percentages(hourly_delivery, total_insulin):
     # add percentage breakdown per hour
-    total_insulin = basal_insulin + bolus_insulin
     for hour in hourly_delivery:
         hour_total = hourly_delivery[hour]['basal'] + hourly_delivery[hour]['bolus']
         hourly_delivery[hour]['percent'] = (hour_total / total_insulin) * 100 if total_insulin > 0 else 0
 
-    return basal_insulin, bolus_insulin, dict(hourly_delivery)
-
 
 def find_active_rate_at_time(current_time, profile_dict, temp_basal_dict):
     temp_basal = find_active_temp_basal(current_time, temp_basal_dict)
@@ -102,14 +231,22 @@ def find_profile_rate(current_time, profile_dict):
 
 
 ### Other functions
-def hourly_insulin_plot(hourly_data: dict, tz):
+@instrumentation.timed("plot.hourly_insulin")
+def hourly_insulin_plot(hourly_data, tz):
     """
     Plots basal and bolus insulin delivery per hour using a bar chart.
+    Accepts the hourly dict or the DataFrame returned by columnar_insulin_delivery.
     """
+    # plotting libraries are only loaded once a plot is asked for
+    import pandas as pd
+    import matplotlib.pyplot as plt
 
     # Convert to DataFrame
-    df = pd.DataFrame.from_dict(hourly_data, orient='index')
-    df.index = pd.to_datetime(df.index)
+    if isinstance(hourly_data, pd.DataFrame):
+        df = hourly_data.copy()
+    else:
+        df = pd.DataFrame.from_dict(hourly_data, orient='index')
+        df.index = pd.to_datetime(df.index)
 
     # Convert timezone
     df.index = df.index.tz_convert(tz)
@@ -0,0 +1,233 @@
+"""
+Incremental insulin and glucose totals for live monitoring ("last 24h", "today").
+
+LiveAccumulator keeps per-interval buckets of basal, bolus and glucose and updates them from new
+records only: ingest() adds treatments, CGM entries and profile switches as they arrive, and
+advance(now) integrates basal over just the time since the previous update. With a sliding window,
+buckets that fall out of it are dropped and subtracted from the running totals. poll() pulls what
+was uploaded since the last poll from Nightscout.
+
+A record timestamped before the already integrated time (a late upload, a new profile switch)
+rewinds integration to its bucket, so an update costs the new events plus how late they are.
+"""
+from bisect import bisect_left, insort
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pandas as pd
+
+from basalinsulin import basalprofiles
+from basalschedule import BasalSchedule
+from columnarcalculator import columnar_insulin_delivery
+from dataretriever import dataFetcher, newestBefore
+from records import MGDL_PER_MMOL, Boluses, TempBasals, datetime_ms, ms_to_datetime, record_ms
+from urlformater import timestampvariable
+
+SCHEDULE_END = "9999-12-31T00:00:00"
+NO_BOLUSES = Boluses([], [])
+# each poll re-reads this far before the newest record seen, for uploads that arrive out of order
+POLL_LOOKBACK = timedelta(hours=1)
+
+
+def naive(ms: int) -> str:
+    return ms_to_datetime(ms).replace(tzinfo=None).isoformat(timespec="seconds")
+
+
+class Bucket:
+    __slots__ = ("basal", "bolus", "glucose_sum", "boluses", "glucose")
+
+    def __init__(self):
+        self.basal = self.bolus = self.glucose_sum = 0.0
+        self.boluses = {}  # ms -> units
+        self.glucose = {}  # ms -> mmol/L
+
+
+class LiveAccumulator:
+    def __init__(self, nsid: str, start: datetime, *, window: timedelta = None, interval_minutes: int = 60):
+        """
+        start is where the totals begin (e.g. local midnight for "today"). With a window (e.g.
+        timedelta(hours=24)) the start slides forward on every advance(); expiry is per bucket, so
+        the totals cover the window rounded out to whole intervals.
+        """
+        self.nsid = nsid
+        self.window = window
+        self.interval = interval_minutes * 60_000
+        self.start = self._floor(datetime_ms(start))
+        self.integrated = self.start  # basal is integrated over [start, integrated)
+        self.buckets = {}  # right-edge label ms -> Bucket
+        self.basal = self.bolus = self.glucose_sum = 0.0
+        self.glucose_count = 0
+        self.profiles = {}
+        self.schedule = None
+        self._temp_starts = []  # sorted
+        self._temps = {}  # start ms -> (end ms, rate)
+        self._longest_temp = 0
+        self._cursors = {}  # collection -> newest record ms seen
+
+    def _floor(self, ms: int) -> int:
+        return ms // self.interval * self.interval
+
+    def _bucket(self, ms: int) -> Bucket:
+        label = self._floor(ms) + self.interval
+        bucket = self.buckets.get(label)
+        if bucket is None:
+            bucket = self.buckets[label] = Bucket()
+        return bucket
+
+    def _seen(self, collection: str, ms: int):
+        self._cursors[collection] = max(self._cursors.get(collection, ms), ms)
+
+    def ingest(self, treatments=(), entries=(), profiles=()):
+        for record in profiles:
+            self.ingest_profile(record)
+        for record in treatments:
+            self.ingest_treatment(record)
+        for record in entries:
+            self.ingest_entry(record)
+
+    def ingest_profile(self, record: dict):
+        ms = record_ms(record, timestampvariable("profiles"))
+        self._seen("profiles", ms)
+        profile = basalprofiles([record])
+        # every poll reads the newest profile again; only a new or edited one changes the schedule
+        if all(self.profiles.get(date) == value for date, value in profile.items()):
+            return
+        self.profiles.update(profile)
+        self.schedule = BasalSchedule(self.profiles, SCHEDULE_END)
+        self._rewind(ms)
+
+    def ingest_treatment(self, record: dict):
+        ms = record_ms(record, timestampvariable("treatments"))
+        self._seen("treatments", ms)
+        if record["eventType"] in ("Temp Basal", "Suspend Pump"):
+            if record["eventType"] == "Temp Basal":
+                duration, rate = record["duration"], record["rate"]
+            else:
+                duration, rate = 30, 0  # no duration provided
+            end = ms + int(duration * 60_000)
+            if end <= self.start or self._temps.get(ms) == (end, rate):
+                return
+            if ms not in self._temps:
+                insort(self._temp_starts, ms)
+            self._temps[ms] = (end, rate)
+            self._longest_temp = max(self._longest_temp, end - ms)
+            self._rewind(ms)
+        elif float(record.get("insulin") or 0) > 0 and ms >= self.start:
+            units = float(record["insulin"])
+            bucket = self._bucket(ms)
+            change = units - bucket.boluses.get(ms, 0.0)
+            bucket.boluses[ms] = units
+            bucket.bolus += change
+            self.bolus += change
+
+    def ingest_entry(self, record: dict):
+        if 'sgv' not in record:
+            return
+        ms = record_ms(record, timestampvariable("entries"))
+        self._seen("entries", ms)
+        if ms < self.start:
+            return
+        value = record['sgv'] / MGDL_PER_MMOL
+        bucket = self._bucket(ms)
+        previous = bucket.glucose.get(ms)
+        if previous is None:
+            self.glucose_count += 1
+            previous = 0.0
+        bucket.glucose[ms] = value
+        bucket.glucose_sum += value - previous
+        self.glucose_sum += value - previous
+
+    def _rewind(self, ms: int):
+        # forget the basal integrated from ms's bucket onwards so advance() redoes it
+        to = max(self._floor(ms), self.start)
+        if to >= self.integrated:
+            return
+        for label in range(to + self.interval, self._floor(self.integrated - 1) + 2 * self.interval, self.interval):
+            bucket = self.buckets.get(label)
+            if bucket is not None:
+                self.basal -= bucket.basal
+                bucket.basal = 0.0
+        self.integrated = to
+
+    def advance(self, now: datetime = None):
+        """Integrate basal up to `now` and, with a window, expire the buckets that left it."""
+        now_ms = datetime_ms(now or datetime.now(timezone.utc))
+        if self.window is not None:
+            self._expire(self._floor(now_ms - self.window // timedelta(milliseconds=1)))
+        if self.schedule is None or now_ms <= self.integrated:
+            return
+        # nothing to integrate before the first profile
+        begin = max(self.integrated, int(self.schedule.starts[0] * 1000))
+        if begin < now_ms:
+            self._integrate(begin, now_ms)
+        self.integrated = now_ms
+
+    def _integrate(self, begin: int, end: int):
+        lo = bisect_left(self._temp_starts, begin - self._longest_temp)
+        hi = bisect_left(self._temp_starts, end)
+        starts = self._temp_starts[lo:hi]
+        temps = TempBasals(starts, [(self._temps[ms][0] - ms) / 60_000 for ms in starts],
+                           [self._temps[ms][1] for ms in starts])
+        _, _, delivery = columnar_insulin_delivery(self.schedule, temps, NO_BOLUSES, ms_to_datetime(begin),
+                                                   ms_to_datetime(end), self.interval // 60_000)
+        first = self._floor(begin) + self.interval
+        for label, units in zip(range(first, first + len(delivery) * self.interval, self.interval),
+                                delivery['basal'].tolist()):
+            if units:
+                self._bucket(label - 1).basal += units
+                self.basal += units
+
+    def _expire(self, start: int):
+        if start <= self.start:
+            return
+        for label in [label for label in self.buckets if label <= start]:
+            bucket = self.buckets.pop(label)
+            self.basal -= bucket.basal
+            self.bolus -= bucket.bolus
+            self.glucose_sum -= bucket.glucose_sum
+            self.glucose_count -= len(bucket.glucose)
+        # temps that ended before the new start can no longer contribute
+        expired = bisect_left(self._temp_starts, start - self._longest_temp)
+        for ms in self._temp_starts[:expired]:
+            if self._temps[ms][0] <= start:
+                del self._temps[ms]
+        self._temp_starts = [ms for ms in self._temp_starts if ms in self._temps]
+        self.start = start
+        self.integrated = max(self.integrated, start)
+
+    def poll(self, now: datetime = None):
+        """Fetch the records uploaded since the last poll, ingest them and advance to `now`."""
+        now = now or datetime.now(timezone.utc)
+        end = naive(datetime_ms(now))
+        lookback = POLL_LOOKBACK // timedelta(milliseconds=1)
+        if "profiles" not in self._cursors:
+            # the profile running at the start, then any switches after it
+            self.ingest(profiles=newestBefore(self.nsid, "profiles", naive(self.start)))
+        since = {collection: naive(self._cursors.get(collection, self.start) - lookback)
+                 for collection in ("profiles", "treatments", "entries")}
+        self.ingest(profiles=dataFetcher(self.nsid, "profiles", since["profiles"], end),
+                    treatments=dataFetcher(self.nsid, "treatments", since["treatments"], end),
+                    entries=dataFetcher(self.nsid, "entries", since["entries"], end))
+        self.advance(now)
+        return self
+
+    @property
+    def total(self) -> float:
+        return self.basal + self.bolus
+
+    @property
+    def average_glucose(self):
+        return self.glucose_sum / self.glucose_count if self.glucose_count else None
+
+    def delivery(self) -> pd.DataFrame:
+        """Per-interval basal, bolus, percent of total and mean glucose, like columnar_insulin_delivery."""
+        labels = sorted(self.buckets)
+        buckets = [self.buckets[label] for label in labels]
+        basal = np.array([bucket.basal for bucket in buckets])
+        bolus = np.array([bucket.bolus for bucket in buckets])
+        glucose = np.array([bucket.glucose_sum / len(bucket.glucose) if bucket.glucose else np.nan
+                            for bucket in buckets])
+        total = self.total
+        percent = (basal + bolus) / total * 100 if total > 0 else np.zeros(len(labels))
+        return pd.DataFrame({'basal': basal, 'bolus': bolus, 'percent': percent, 'glucose': glucose},
+                            index=pd.to_datetime(np.array(labels, dtype=np.int64), unit='ms', utc=True))
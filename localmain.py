@@ -1,92 +1,176 @@
-import pandas as pd
-import matplotlib.pyplot as plt
+"""
+Command-line insulin calculator.
+
+    python localmain.py 099889e3-4db0-524c-be0f-9f627f4c86b6 2026-01-20 2026-01-25
+    python localmain.py NSID "2026-01-20 06:00" "2026-01-21 06:00" --tz America/Vancouver --json
+
+Start and end are wall-clock times in --tz. pandas and matplotlib are only imported for the table
+and the plots, so --json/--no-plots runs skip them; `python benchmark.py --imports` measures the
+cold start.
+"""
+import argparse
+import json
+import sys
+from contextlib import nullcontext
 from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
 
-# Import your local modules
-from basalinsulin import basalinsulin
+from basalinsulin import basalschedule
 from treatmentinsulin import treatmentinsulin
 from glucosereadings import glucosereadings
+from dataretriever import fetchConcurrently, useCache, useSource
+from urlformater import PAGE_SIZE
 from insulincalculator import calculate_insulin_delivery, hourly_insulin_plot
-from glucosecalculator import *
-
-# ==========================================
-# USER CONFIGURATION (UTC ONLY)
-# ==========================================
-NSID = "099889e3-4db0-524c-be0f-9f627f4c86b6"
-START_UTC = "2026-01-20 00:00"
-END_UTC = "2026-01-25 00:00"
-
-# ==========================================
-
-def insulinused():
-    print("--- Nightscout Insulin Calculator (UTC Mode) ---")
-
-    # 1. Parse Strings directly to UTC Datetime objects
-    dt_format = "%Y-%m-%d %H:%M"
-    try:
-        starttime_utc = datetime.strptime(START_UTC, dt_format).replace(tzinfo=timezone.utc)
-        endtime_utc = datetime.strptime(END_UTC, dt_format).replace(tzinfo=timezone.utc)
-    except ValueError as e:
-        print(f"Error parsing dates: {e}")
-        return
-
-    if endtime_utc <= starttime_utc:
-        print("Error: End time must be after start time.")
-        return
-
-    print(f"Time Range: {starttime_utc} to {endtime_utc} (UTC)")
-
-    # 2. Create Naive Strings for Data Fetchers (removing +00:00 suffix)
+from insulinaction import CURVES, LOOKBACK
+from resultexport import FORMATS, export_results
+from glucosecalculator import avg_glucose_plot
+from ambulatoryprofile import ambulatory_profile, ambulatory_profile_plot, slot_rows
+import instrumentation
+
+GLUCOSE_SHARDS = 4
+
+
+def parse_time(value: str, tz) -> datetime:
+    when = datetime.fromisoformat(value)
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=tz)
+    return when.astimezone(timezone.utc)
+
+
+def insulinused(nsid: str, starttime_utc: datetime, endtime_utc: datetime, glucose_shards: int = GLUCOSE_SHARDS,
+                action: str = None, export: str = None, export_format: str = None):
+    """
+    Returns (summary, hourly delivery dict, records.GlucoseSeries) for [starttime_utc, endtime_utc).
+    action="exponential"/"bilinear" adds insulin on board and activity to every hour.
+    export="DIR" also writes the delivery, glucose, treatments and basal schedule there (see resultexport).
+    """
+    # Naive strings for the data fetchers
     starttime_naive = starttime_utc.strftime('%Y-%m-%dT%H:%M:%S')
     endtime_naive = endtime_utc.strftime('%Y-%m-%dT%H:%M:%S')
-
-    # 3. Fetch Data
-    print("\nFetching Data...")
-    basaldic = basalinsulin(NSID, starttime_naive, endtime_naive)
-    treatmentdic = treatmentinsulin(NSID, starttime_naive, endtime_naive)
-    glucosedic = glucosereadings(NSID, starttime_naive, endtime_naive)
-
-    # Unpack treatments
-    tempdic = treatmentdic[0]
-    bolusdic = treatmentdic[1]
-
-    # 4. Calculate Stats
-    print("Calculating Stats...")
-    insulin_list = calculate_insulin_delivery(basaldic, tempdic, bolusdic, starttime_utc, endtime_utc)
-
-    basal_insulin = insulin_list[0]
-    bolus_insulin = insulin_list[1]
-    total_insulin = basal_insulin + bolus_insulin
-    hourly_insulin = insulin_list[2]
-
-    avgglucose = average_glucose(glucosedic, starttime_utc, endtime_utc)
-
-    # 5. Output Results
-    insulin_dic = {
-        'Basal (U)': [basal_insulin],
-        'Bolus (U)': [bolus_insulin],
-        'Total (U)': [total_insulin],
-        'Avg BG (mM)': [avgglucose]
+    # insulin given before the window is still on board in it
+    history_naive = (starttime_utc - LOOKBACK).strftime('%Y-%m-%dT%H:%M:%S') if action else starttime_naive
+
+    fetched = fetchConcurrently({
+        "basal": (basalschedule, nsid, history_naive, endtime_naive),
+        "treatments": (treatmentinsulin, nsid, history_naive, endtime_naive, PAGE_SIZE, 1, True),
+        "glucose": (glucosereadings, nsid, starttime_naive, endtime_naive, PAGE_SIZE, glucose_shards, True),
+    })
+    tempdic, bolusdic = fetched["treatments"]
+    glucose = fetched["glucose"]
+
+    basal_insulin, bolus_insulin, hourly_insulin = calculate_insulin_delivery(
+        fetched["basal"], tempdic, bolusdic, starttime_utc, endtime_utc, engine="columnar", action=action)
+    stats = glucose.stats(starttime_utc, endtime_utc)
+    if export:
+        export_results(export, nsid, format=export_format, delivery=hourly_insulin, glucose=glucose, temps=tempdic,
+                       boluses=bolusdic, schedule=fetched["basal"], start=starttime_utc, end=endtime_utc)
+
+    summary = {
+        'Basal (U)': basal_insulin,
+        'Bolus (U)': bolus_insulin,
+        'Total (U)': basal_insulin + bolus_insulin,
+        'Avg BG (mM)': stats['mean'],
+        'SD (mM)': stats['sd'],
+        'Time in Range (%)': stats['time_in_range'],
+        'GMI (%)': stats['gmi'],
     }
-
-    df = pd.DataFrame(insulin_dic)
-    print("\n" + "=" * 40)
-    print(df.to_string(index=False))
-    print("=" * 40)
-
-    # 6. Display Plots (Passing UTC as the timezone)
-    print("\nDisplaying plots... (Close windows to exit)")
-
-    fig1 = hourly_insulin_plot(hourly_insulin, timezone.utc)
-    if fig1:
-        plt.figure(fig1.number)
-        plt.title("Hourly Insulin (UTC)")
+    if action and hourly_insulin:
+        summary['IOB at end (U)'] = hourly_insulin[max(hourly_insulin)]['iob']
+    return summary, hourly_insulin, glucose
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Insulin delivered and glucose summary for a Nightscout site.")
+    parser.add_argument("nsid", help="Nightscout ID")
+    parser.add_argument("start", help='start, e.g. 2026-01-20 or "2026-01-20 06:00"')
+    parser.add_argument("end", help="end, same format")
+    parser.add_argument("--tz", default="UTC", help="timezone of start/end and of the plots (default UTC)")
+    parser.add_argument("--json", action="store_true", help="print the summary and hourly delivery as JSON")
+    parser.add_argument("--no-plots", action="store_true", help="skip the plots")
+    parser.add_argument("--no-cache", action="store_true", help="don't keep downloaded records on disk")
+    parser.add_argument("--replay", metavar="DIR", help="read entries/treatments/profiles exports instead of Nightscout")
+    parser.add_argument("--glucose-shards", type=int, default=GLUCOSE_SHARDS)
+    parser.add_argument("--iob", nargs="?", const="exponential", choices=CURVES, metavar="CURVE",
+                        help="add insulin on board and activity per hour (exponential, the default, or bilinear)")
+    parser.add_argument("--time-of-day", nargs="?", const=60, type=int, metavar="MINUTES",
+                        help="median/IQR of insulin and glucose by time of day in --tz, in slots of MINUTES, "
+                             "a multiple of 60 that divides a day (default 60)")
+    parser.add_argument("--export", metavar="DIR", help="write the results as Parquet/Arrow/CSV tables partitioned by NSID and date")
+    parser.add_argument("--export-format", choices=FORMATS,
+                        help="default Parquet when pyarrow is installed, else CSV")
+    parser.add_argument("--report", metavar="FILE", help="write stage timings and counters as JSON ('-' for stderr)")
+    parser.add_argument("--profile", metavar="FILE", help="write cProfile statistics for pstats/snakeviz")
+    args = parser.parse_args(argv)
+
+    tz = ZoneInfo(args.tz)
+    try:
+        starttime_utc = parse_time(args.start, tz)
+        endtime_utc = parse_time(args.end, tz)
+    except ValueError as e:
+        parser.error(f"Error parsing dates: {e}")
+    if endtime_utc <= starttime_utc:
+        parser.error("End time must be after start time.")
+    if args.time_of_day and (args.time_of_day % 60 or (24 * 60) % args.time_of_day):
+        parser.error("--time-of-day must be a multiple of the hourly delivery interval that divides a day.")
+
+    if args.replay:
+        from datasource import FileSource
+        useSource(FileSource(args.replay))
+    elif not args.no_cache:
+        from responsecache import ResponseCache
+        useCache(ResponseCache())
+
+    recording = instrumentation.run(profile=bool(args.profile)) if args.report or args.profile else nullcontext()
+    # the run ends before plt.show() so the time spent looking at the plots isn't counted
+    with recording as report:
+        summary, hourly_insulin, glucose = insulinused(args.nsid, starttime_utc, endtime_utc, args.glucose_shards,
+                                                       args.iob, args.export, args.export_format)
+
+        if args.time_of_day:
+            profile = ambulatory_profile(hourly_insulin, glucose, tz, start=starttime_utc, end=endtime_utc,
+                                         slot_minutes=args.time_of_day)
+
+        if args.json:
+            output = {
+                "nsid": args.nsid, "start": starttime_utc.isoformat(), "end": endtime_utc.isoformat(),
+                **summary,
+                "hourly": [{"time": time.isoformat(), **delivery}
+                           for time, delivery in sorted(hourly_insulin.items())],
+            }
+            if args.time_of_day:
+                output["time_of_day"] = slot_rows(profile)
+            print(json.dumps(output, indent=2))
+        else:
+            import pandas as pd
+            print(f"Time Range: {starttime_utc} to {endtime_utc} (UTC)")
+            print("\n" + "=" * 40)
+            print(pd.DataFrame({key: [value] for key, value in summary.items()}).to_string(index=False))
+            print("=" * 40)
+            if args.time_of_day:
+                print(f"\nBy time of day ({args.tz}): insulin U/h, glucose mmol/L")
+                print(pd.DataFrame(slot_rows(profile, ("p25", "p50", "p75"))).set_index("slot").round(2).to_string())
+
+        if not args.no_plots:
+            import matplotlib.pyplot as plt
+            fig1 = hourly_insulin_plot(hourly_insulin, tz)
+            fig1.axes[0].set_title(f"Hourly Insulin ({args.tz})")
+            fig2 = avg_glucose_plot(glucose, starttime_utc, endtime_utc, 30, tz)
+            fig2.axes[0].set_title(f"Avg Glucose ({args.tz})")
+            if args.time_of_day:
+                ambulatory_profile_plot(profile)
+
+    if report is not None:
+        if args.report == "-":
+            print(report.to_json(), file=sys.stderr)
+        elif args.report:
+            with open(args.report, "w") as f:
+                f.write(report.to_json())
+        if args.profile:
+            report.dump_profile(args.profile)
+
+    if not args.no_plots:
         plt.show()
 
-    fig2 = avg_glucose_plot(glucosedic, starttime_utc, endtime_utc, 30, timezone.utc)
-    if fig2:
-        plt.figure(fig2.number)
-        plt.title("Avg Glucose (UTC)")
-        plt.show()
 
-insulinused()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -3,19 +3,53 @@ This script is designed to quantify the amount of insulin delivered within a sel
 
 """
 #  $ pip install streamlit streamlit-tz tzdata  (tzdata for servers w/o zoneinfo DB)
-from basalinsulin import basalinsulin
-from treatmentinsulin import treatmentinsulin
-from glucosereadings import glucosereadings
+from dataretriever import useCache
+from responsecache import ResponseCache
+from resultcache import WindowCache
+from progressive import ProgressiveRun
+import instrumentation
+import queue
+from contextlib import nullcontext
 import streamlit as st
 from datetime import datetime, timezone, timedelta
 from zoneinfo import ZoneInfo            # stdlib ≥3.9
 from streamlit_tz import streamlit_tz    # community component
 import streamlit as st
 import pandas as pd
-from insulincalculator import calculate_insulin_delivery, hourly_insulin_plot
+from plotrender import hourly_insulin_image, glucose_image
+from resultexport import export_zip
 from glucosecalculator import *
 from datetime import time
 
+# CGM entries are the largest download, so split their range across parallel requests
+GLUCOSE_SHARDS = 4
+
+@st.cache_resource
+def response_cache() -> ResponseCache:
+    """One on-disk Nightscout cache shared by every session of the app."""
+    return ResponseCache()
+
+@st.cache_resource
+def window_cache() -> WindowCache:
+    """Fetched data and hourly deliveries per window, so re-submits only fetch and compute what changed."""
+    return WindowCache(glucose_shards=GLUCOSE_SHARDS)
+
+@st.cache_data(max_entries=8)
+def results_zip(nsid: str, start: datetime, end: datetime, version: int, _delivery, _window) -> bytes:
+    """The results download, built once per NSID, window and version of the fetched data."""
+    return export_zip(nsid, delivery=_delivery, glucose=_window.glucose, temps=_window.temps, boluses=_window.boluses,
+                      schedule=_window.schedule(end), start=start, end=end)
+
+def summary_table(basal_insulin, bolus_insulin, glucose_stats) -> pd.DataFrame:
+    insulin_dic = {'Basal Insulin (U)': basal_insulin, 'Bolus Insulin (U)': bolus_insulin, 'Total Insulin (U)': basal_insulin + bolus_insulin, 'Average Glucose (mM)': glucose_stats['mean'],
+                   'Glucose SD (mM)': glucose_stats['sd'], 'Time in Range (%)': glucose_stats['time_in_range'], 'GMI (%)': glucose_stats['gmi']}
+    return pd.DataFrame(insulin_dic, index=[1])
+
+def progress_text(run: ProgressiveRun, tz) -> str:
+    text = f"Up to {run.done.astimezone(tz):%Y-%m-%d %H:%M}: {run.pages} pages, {run.records} records downloaded"
+    eta = run.eta()
+    return text if eta is None else f"{text}, about {eta:.0f}s left"
+
 def get_default(key, default_val):
     if key not in st.session_state:
         st.session_state[key] = default_val
@@ -64,6 +98,7 @@ if __name__ == "__main__":
         or st.context.timezone  # Streamlit ≥1.33; sometimes empty on hot-reload
         or "UTC"
     )
+    useCache(response_cache())
     st.info(f"🕑 Your browser appears to be set to **{detected_tz}**.")
     tz = pick_timezone(detected_tz)      # user can keep / override
 
@@ -84,6 +119,9 @@ if __name__ == "__main__":
                                      value=get_default("end_time", time(3, 0)),
                                      key="end_time")
 
+        progressive = st.checkbox("Show results while downloading", value=True)
+        show_report = st.checkbox("Collect a timing report")
+        offer_download = st.checkbox("Offer the results as a download (zip)")
         submitted = st.form_submit_button("Submit")
 
     # 3.  Build aware datetimes and convert to UTC
@@ -104,34 +142,58 @@ if __name__ == "__main__":
         st.write("End   (UTC):", endtime.isoformat())
 
 
-        # offset naive times for calculations
-        starttime_naive = starttime.replace(tzinfo=None).isoformat(timespec="seconds")
-        endtime_naive = endtime.replace(tzinfo=None).isoformat(timespec="seconds")
-
-        # Get basal insulin
-        basaldic = basalinsulin(nsid, starttime_naive, endtime_naive)
-
-        # Get treatment insulin
-        treatmentdic = treatmentinsulin(nsid, starttime_naive, endtime_naive)
-        tempdic = treatmentdic[0]
-        bolusdic = treatmentdic[1]
-
-        # Get glucose
-        glucosedic = glucosereadings(nsid, starttime_naive, endtime_naive)
-
-        # Calculate insulin delivery
-        insulin_list = calculate_insulin_delivery(basaldic, tempdic, bolusdic, starttime, endtime)
-        basal_insulin = insulin_list[0]
-        bolus_insulin = insulin_list[1]
-        total_insulin = basal_insulin + bolus_insulin
-        hourly_insulin = insulin_list[2]
-
-        # Calculate Glucose
-        avgglucose = average_glucose(glucosedic, starttime, endtime)
-
-        # Output
-        st.success(f"Insulin from {start_local} to {end_local}:")
-        insulin_dic = {'Basal Insulin (U)': basal_insulin, 'Bolus Insulin (U)': bolus_insulin, 'Total Insulin (U)': total_insulin, 'Average Glucose (mM)': avgglucose}
-        st.table(pd.DataFrame(insulin_dic, index=[1]))
-        st.pyplot(hourly_insulin_plot(hourly_insulin, tz))
-        st.pyplot(avg_glucose_plot(glucosedic, starttime, endtime, 30, tz))
+        # each session records its own report; cProfile stays off in the shared server
+        recording = instrumentation.run() if show_report else nullcontext()
+        with recording as report:
+            # Get basal, treatment and glucose data and the insulin delivered, reusing earlier submits
+            cache = window_cache()
+            if progressive:
+                # the totals and charts so far are redrawn after every chunk
+                st.success(f"Insulin from {start_local} to {end_local}:")
+                progress = st.progress(0.0, text="Downloading the first day …")
+                table, hourly_chart, glucose_chart = st.empty(), st.empty(), st.empty()
+                run = ProgressiveRun(cache, nsid, starttime, endtime)
+                run.start()
+                try:
+                    while True:
+                        try:
+                            update = run.updates.get(timeout=0.5)
+                        except queue.Empty:
+                            progress.progress(run.fraction(), text=progress_text(run, tz))
+                            continue
+                        if update is None:
+                            break
+                        if isinstance(update, Exception):
+                            raise update
+                        hourly_insulin, glucose = update.delivery, update.glucose
+                        table.table(summary_table(update.basal, update.bolus, glucose.stats(starttime, update.end)))
+                        hourly_chart.image(hourly_insulin_image(hourly_insulin, tz))
+                        glucose_chart.image(glucose_image(glucose, starttime, update.end, 30, tz))
+                        progress.progress(run.fraction(), text=progress_text(run, tz))
+                finally:
+                    # a rerun stops this script; let the download stop with it
+                    run.cancel()
+            else:
+                basal_insulin, bolus_insulin, hourly_insulin = cache.delivery(nsid, starttime, endtime)
+                glucose = cache.data(nsid, starttime, endtime).glucose
+
+                # Calculate Glucose
+                glucose_stats = glucose.stats(starttime, endtime)
+
+                # Output
+                st.success(f"Insulin from {start_local} to {end_local}:")
+                st.table(summary_table(basal_insulin, bolus_insulin, glucose_stats))
+                st.image(hourly_insulin_image(hourly_insulin, tz))
+                st.image(glucose_image(glucose, starttime, endtime, 30, tz))
+
+            if offer_download:
+                window = cache.data(nsid, starttime, endtime)
+                st.download_button("Download results (zip)",
+                                   results_zip(nsid, starttime, endtime, window.version, hourly_insulin, window),
+                                   file_name=f"{nsid}_{start_local:%Y%m%d}_{end_local:%Y%m%d}.zip",
+                                   mime="application/zip")
+
+        if report is not None:
+            with st.expander("Timing report"):
+                st.json(report.as_dict())
+                st.download_button("Download report (JSON)", report.to_json(), file_name="run_report.json")
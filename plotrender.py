@@ -0,0 +1,188 @@
+"""
+Fast figure rendering from pre-aggregated arrays, with a cache of the rendered images.
+
+hourly_insulin_image() and glucose_image() work from the per-interval arrays the calculators
+already produce. They don't convert dicts to DataFrames, convert timezones or sort. Ranges with more
+intervals than the figure has room for are merged into wider bins first, and each series is drawn
+as one step artist instead of one patch per bar. Figures are plain matplotlib Figures, not pyplot
+ones, so nothing is kept in pyplot's registry. They are closed as soon as they are saved. Rendered
+PNG/SVG bytes are kept in an LRU keyed by a hash of the data, the timezone, the interval and the
+figure size.
+"""
+import hashlib
+import io
+import math
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from matplotlib.figure import Figure
+import matplotlib.dates as mdates
+
+from records import GlucoseSeries, datetime_ms
+
+MS_PER_DAY = 86_400_000
+# drawn bins per inch of figure width, about two pixels per bin at the default dpi
+BINS_PER_INCH = 50
+
+
+def as_arrays(delivery, interval_minutes: int = 60):
+    """(right-edge labels ms, basal, bolus) on a contiguous grid from the DataFrame or hourly dict."""
+    if hasattr(delivery, "index"):
+        labels = delivery.index.as_unit("ms").asi8
+        return labels, delivery['basal'].to_numpy(dtype=float), delivery['bolus'].to_numpy(dtype=float)
+    interval = interval_minutes * 60_000
+    times = np.array(sorted(datetime_ms(when) for when in delivery), dtype=np.int64)
+    if len(times) == 0:
+        return times, np.empty(0), np.empty(0)
+    # the sweep/legacy dicts skip empty hours
+    labels = np.arange(times[0], times[-1] + interval, interval, dtype=np.int64)
+    basal, bolus = np.zeros(len(labels)), np.zeros(len(labels))
+    slots = (times - times[0]) // interval
+    ordered = sorted(delivery.items(), key=lambda item: item[0])
+    basal[slots] = [values['basal'] for _, values in ordered]
+    bolus[slots] = [values['bolus'] for _, values in ordered]
+    return labels, basal, bolus
+
+
+def bin_factor(n: int, max_bins: int) -> int:
+    return max(1, math.ceil(n / max_bins))
+
+
+def downsample_sums(values, factor: int):
+    if factor == 1:
+        return values
+    return np.add.reduceat(values, np.arange(0, len(values), factor))
+
+
+def downsample_means(values, factor: int):
+    if factor == 1:
+        return values
+    starts = np.arange(0, len(values), factor)
+    present = ~np.isnan(values)
+    counts = np.add.reduceat(present.astype(float), starts)
+    sums = np.add.reduceat(np.where(present, values, 0.0), starts)
+    with np.errstate(invalid='ignore'):
+        return np.where(counts > 0, sums / counts, np.nan)
+
+
+def date_numbers(ms):
+    # matplotlib dates are days since 1970-01-01 UTC
+    return np.asarray(ms, dtype=np.float64) / MS_PER_DAY
+
+
+def date_axis(ax, tz):
+    locator = mdates.AutoDateLocator(tz=tz)
+    ax.xaxis.set_major_locator(locator)
+    ax.xaxis.set_major_formatter(mdates.ConciseDateFormatter(locator, tz=tz))
+
+
+def save(fig: Figure, format: str, dpi: int) -> bytes:
+    out = io.BytesIO()
+    fig.savefig(out, format=format, dpi=dpi, bbox_inches='tight')
+    fig.clear()
+    return out.getvalue()
+
+
+def data_hash(*arrays) -> str:
+    digest = hashlib.blake2b(digest_size=16)
+    for array in arrays:
+        data = np.ascontiguousarray(array)
+        digest.update(str(data.dtype).encode() + str(data.shape).encode())
+        digest.update(data.tobytes())
+    return digest.hexdigest()
+
+
+class PlotCache:
+    """Image bytes, least recently used evicted once their total passes max_bytes. Thread safe."""
+
+    def __init__(self, max_bytes: int = 32 * 2 ** 20):
+        self.max_bytes = max_bytes
+        self.total = 0
+        self.images = OrderedDict()  # key -> bytes
+        self._lock = threading.Lock()
+
+    def get_or_render(self, key, render) -> bytes:
+        with self._lock:
+            image = self.images.get(key)
+            if image is not None:
+                self.images.move_to_end(key)
+                return image
+        # rendered outside the lock; two sessions missing the same key both render it
+        image = render()
+        with self._lock:
+            if key not in self.images:
+                self.images[key] = image
+                self.total += len(image)
+            while self.total > self.max_bytes and len(self.images) > 1:
+                _, evicted = self.images.popitem(last=False)
+                self.total -= len(evicted)
+        return image
+
+
+# Shared by every session (and so every script thread) of a long-running app
+PLOT_CACHE = PlotCache()
+
+
+def render_hourly_insulin(labels, basal, bolus, interval_minutes: int, tz, *, size=(10, 5), dpi: int = 100,
+                          format: str = "png") -> bytes:
+    interval = interval_minutes * 60_000
+    factor = bin_factor(len(labels), int(size[0] * BINS_PER_INCH))
+    basal, bolus = downsample_sums(basal, factor), downsample_sums(bolus, factor)
+    edges = date_numbers(np.append(labels[::factor] - interval, labels[-1]) if len(labels) else [])
+
+    fig = Figure(figsize=size)
+    ax = fig.subplots()
+    if len(basal):
+        ax.stairs(basal, edges, fill=True, label='Basal')
+        ax.stairs(basal + bolus, edges, baseline=basal, fill=True, label='Bolus')
+    hours = interval_minutes * factor / 60
+    per = "Hour" if hours == 1 else f"{hours:g} Hours"
+    ax.set_title(f"Insulin Delivery per {per} (Basal + Bolus)")
+    ax.set_xlabel("Time")
+    ax.set_ylabel("Insulin Units")
+    ax.legend()
+    ax.grid(True)
+    date_axis(ax, tz)
+    return save(fig, format, dpi)
+
+
+def render_glucose(labels, means, minutes: int, tz, *, size=(10, 5), dpi: int = 100, format: str = "png") -> bytes:
+    factor = bin_factor(len(labels), int(size[0] * BINS_PER_INCH))
+    means = downsample_means(means, factor)
+    # label each merged bin by its last interval's right edge
+    ends = labels[factor - 1::factor] if len(labels) else labels
+    if len(ends) < len(means):
+        ends = np.append(ends, labels[-1])
+
+    fig = Figure(figsize=size)
+    ax = fig.subplots()
+    ax.plot(date_numbers(ends), means, marker='o' if len(means) <= 200 else None)
+    ax.set_title(f"Average Glucose Every {minutes * factor} Minutes")
+    ax.set_xlabel("Datetime")
+    ax.set_ylabel("Average Glucose")
+    ax.grid(True)
+    ax.set_ylim(0, 22)
+    date_axis(ax, tz)
+    return save(fig, format, dpi)
+
+
+def hourly_insulin_image(delivery, tz, *, interval_minutes: int = 60, size=(10, 5), dpi: int = 100,
+                         format: str = "png", cache: PlotCache = PLOT_CACHE) -> bytes:
+    """Image bytes of the per-interval insulin bars for a columnar DataFrame or the hourly dict."""
+    labels, basal, bolus = as_arrays(delivery, interval_minutes)
+    key = ("insulin", data_hash(labels, basal, bolus), str(tz), interval_minutes, size, dpi, format)
+    return cache.get_or_render(key, lambda: render_hourly_insulin(labels, basal, bolus, interval_minutes, tz,
+                                                                  size=size, dpi=dpi, format=format))
+
+
+def glucose_image(glucose, start, end, minutes: int, tz, *, size=(10, 5), dpi: int = 100, format: str = "png",
+                  cache: PlotCache = PLOT_CACHE) -> bytes:
+    """Image bytes of the interval-mean glucose line for a records.GlucoseSeries or {datetime: mmol/L} dict."""
+    if not hasattr(glucose, "interval_means"):
+        glucose = GlucoseSeries([datetime_ms(when) for when in glucose], list(glucose.values()))
+    means = glucose.interval_means(start, end, minutes)
+    labels, values = means.index.as_unit("ms").asi8, means.to_numpy()
+    key = ("glucose", data_hash(labels, values), str(tz), minutes, size, dpi, format)
+    return cache.get_or_render(key, lambda: render_glucose(labels, values, minutes, tz,
+                                                           size=size, dpi=dpi, format=format))
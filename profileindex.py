@@ -0,0 +1,78 @@
+"""
+Index of known profile switch timestamps per NSID.
+
+basalinsulin uses it to start the profile query at the last switch known to precede the report,
+instead of searching backwards for it. The index is kept in memory and mirrored to a JSON file.
+Processes sharing the file (cohort workers) merge what's on disk into their own index under a
+lock on a sidecar file before replacing it, so none of them loses another's switches.
+"""
+import fcntl
+import json
+import os
+import sys
+import tempfile
+import threading
+from bisect import bisect_right, insort
+
+DEFAULT_PATH = os.path.join(os.path.expanduser("~"), ".cache", "insulinquantification", "profileindex.json")
+
+
+class ProfileIndex:
+    def __init__(self, path: str = DEFAULT_PATH):
+        """path=None keeps the index in memory only."""
+        self.path = path
+        self._switches = None  # nsid -> sorted list of profile startDate strings
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._switches is None:
+            self._switches = self._read()
+        return self._switches
+
+    def _read(self) -> dict:
+        if not (self.path and os.path.exists(self.path)):
+            return {}
+        try:
+            with open(self.path) as f:
+                return {nsid: sorted(dates) for nsid, dates in json.load(f).items()}
+        except (OSError, ValueError):
+            print(f"Ignoring unreadable profile index {self.path}", file=sys.stderr)
+            return {}
+
+    def latest_before(self, nsid: str, date: str):
+        """The last known profile switch at or before `date`, or None."""
+        with self._lock:
+            dates = self._load().get(nsid, [])
+            index = bisect_right(dates, date)
+            return dates[index - 1] if index else None
+
+    def add(self, nsid: str, dates):
+        with self._lock:
+            known = self._load().setdefault(nsid, [])
+            changed = False
+            for date in dates:
+                index = bisect_right(known, date)
+                if not (index and known[index - 1] == date):
+                    insort(known, date)
+                    changed = True
+            if changed:
+                self._save()
+
+    def _save(self):
+        if not self.path:
+            return
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, exist_ok=True)
+        with open(self.path + ".lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # another process may have saved since this one loaded
+            for nsid, dates in self._read().items():
+                self._switches[nsid] = sorted(set(dates).union(self._switches.get(nsid, ())))
+            fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w") as f:
+                    json.dump(self._switches, f)
+                os.replace(tmp, self.path)
+            except BaseException:
+                os.unlink(tmp)
+                raise
@@ -0,0 +1,102 @@
+"""
+Progressive results for long windows.
+
+ProgressiveRun walks the window forwards in chunks on a background thread, asking the
+WindowCache for [start, chunk end) each time, so every step only fetches and integrates the new
+tail. After each chunk it queues a Snapshot with the totals, the per-interval delivery and the
+glucose so far. The first chunk is short so the first numbers come back quickly, and later chunks
+double up to MAX_CHUNK so a long window doesn't cost many more requests than a single fetch.
+
+Nothing here touches Streamlit: the script thread drains `updates` and draws.
+"""
+import queue
+import threading
+import time
+from datetime import datetime, timedelta
+
+import instrumentation
+
+FIRST_CHUNK = timedelta(days=1)
+MAX_CHUNK = timedelta(days=14)
+
+
+def chunk_ends(start: datetime, end: datetime, first: timedelta = FIRST_CHUNK, largest: timedelta = MAX_CHUNK):
+    """Ends of successive chunks of [start, end), each twice as long as the last up to `largest`."""
+    size, when = first, start
+    while when < end:
+        when = min(when + size, end)
+        yield when
+        size = min(size * 2, largest)
+
+
+class Snapshot:
+    __slots__ = ("end", "basal", "bolus", "delivery", "glucose", "final")
+
+    def __init__(self, end, basal, bolus, delivery, glucose, final):
+        self.end = end
+        self.basal, self.bolus, self.delivery = basal, bolus, delivery
+        self.glucose = glucose
+        self.final = final
+
+
+class ProgressiveRun(threading.Thread):
+    def __init__(self, cache, nsid: str, start: datetime, end: datetime, *,
+                 first_chunk: timedelta = FIRST_CHUNK, max_chunk: timedelta = MAX_CHUNK):
+        super().__init__(daemon=True)
+        self.cache = cache
+        self.nsid, self.start_time, self.end_time = nsid, start, end
+        self.first_chunk, self.max_chunk = first_chunk, max_chunk
+        # Snapshots in order, then None when finished; an exception instead if the run failed
+        self.updates = queue.Queue()
+        self.pages = 0
+        self.records = 0
+        self.done = start
+        self._began = None
+        self._cancelled = threading.Event()
+        self._lock = threading.Lock()
+        # counts go to the run of the thread that created this one
+        self._work = instrumentation.carried(self._chunks)
+
+    def _counted(self, name: str, n):
+        # pages.<collection> and records.<collection> from dataretriever.pageFetcher
+        if name.startswith(("pages.", "records.")):
+            with self._lock:
+                if name.startswith("pages."):
+                    self.pages += n
+                else:
+                    self.records += n
+
+    def run(self):
+        self._work()
+
+    def _chunks(self):
+        self._began = time.monotonic()
+        # only this run's fetches: other sessions count in their own contexts
+        with instrumentation.listening(self._counted):
+            try:
+                for end in chunk_ends(self.start_time, self.end_time, self.first_chunk, self.max_chunk):
+                    if self._cancelled.is_set():
+                        break
+                    with instrumentation.stage("progressive.chunk"):
+                        basal, bolus, delivery = self.cache.delivery(self.nsid, self.start_time, end)
+                        glucose = self.cache.data(self.nsid, self.start_time, end).glucose
+                    self.done = end
+                    self.updates.put(Snapshot(end, basal, bolus, delivery, glucose, end >= self.end_time))
+                self.updates.put(None)
+            except Exception as e:
+                self.updates.put(e)
+
+    def cancel(self):
+        """Stop after the chunk in progress."""
+        self._cancelled.set()
+
+    def fraction(self) -> float:
+        """Share of the window finished so far."""
+        return (self.done - self.start_time) / (self.end_time - self.start_time)
+
+    def eta(self):
+        """Seconds left at the rate the finished chunks took, or None before the first one."""
+        done = self.fraction()
+        if self._began is None or done <= 0:
+            return None
+        return (time.monotonic() - self._began) * (1 - done) / done
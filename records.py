@@ -0,0 +1,340 @@
+"""
+Compact columnar record types for parsed Nightscout data.
+
+Each collection is held as parallel NumPy columns (epoch milliseconds + values) instead of a dict of
+datetimes, and is built in one streaming pass through `array` buffers. Timestamps come from the
+numeric `date`/`mills` fields when the record has them; records with only the ISO string are parsed
+in one vectorized call at the end of the pass.
+"""
+from array import array
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+import threading
+import numpy as np
+
+import instrumentation
+from timecleaner import numeric_ms, record_ms, timestamps_ms
+from urlformater import timestampvariable
+
+MGDL_PER_MMOL = 18.016
+# consensus target range for time in range, mmol/L
+TARGET_LOW = 3.9
+TARGET_HIGH = 10.0
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+# per-window results (interval_means) each GlucoseSeries keeps; the least recently used go first
+WINDOW_RESULTS = 4
+# a cached series can be read by several sessions at once
+_WINDOWS_LOCK = threading.Lock()
+
+
+def held_bytes(value) -> int:
+    """Bytes of the arrays (or pandas objects) in a derived value."""
+    if hasattr(value, "memory_usage"):
+        return int(value.memory_usage(index=True))
+    if hasattr(value, "nbytes"):
+        return int(value.nbytes)
+    if isinstance(value, (tuple, list)):
+        return sum(held_bytes(part) for part in value)
+    return 0
+
+
+class TimeColumn:
+    """
+    Epoch-ms column filled one record at a time from the numeric fields; records that only carry
+    the timestamp string are parsed together, vectorized, when the column is finished.
+    """
+    __slots__ = ("field", "ms", "pending", "strings")
+
+    def __init__(self, field: str):
+        self.field = field
+        self.ms = array('q')
+        self.pending = []  # positions still waiting for their string to be parsed
+        self.strings = []
+
+    def append(self, record: dict):
+        ms = numeric_ms(record)
+        if ms is None:
+            self.pending.append(len(self.ms))
+            self.strings.append(record[self.field])
+            ms = 0
+        self.ms.append(ms)
+
+    def finish(self) -> np.ndarray:
+        times = np.frombuffer(self.ms, dtype=np.int64)
+        if self.pending:
+            instrumentation.count("parsed.string_timestamps", len(self.pending))
+            times = times.copy()
+            times[self.pending] = timestamps_ms(self.strings)
+        return times
+
+
+def datetime_ms(when: datetime) -> int:
+    return (when - EPOCH) // timedelta(milliseconds=1)
+
+
+def ms_to_datetime(ms: int) -> datetime:
+    return datetime.fromtimestamp(ms / 1000, tz=timezone.utc)
+
+
+def _sorted_unique(times: np.ndarray, *columns):
+    # sort by time and keep the last record seen for a repeated timestamp, as the dict parsers do
+    order = np.argsort(times, kind='stable')
+    times = times[order]
+    keep = np.ones(len(times), dtype=bool)
+    keep[:-1] = times[1:] != times[:-1]
+    return (times[keep],) + tuple(column[order][keep] for column in columns)
+
+
+class GlucoseSeries:
+    """
+    CGM readings: int64 epoch-ms `times` (ascending) and float64 mmol/L `values`.
+
+    Window statistics (count, mean, sd, min, max, time in range, GMI) are answered from prefix sums
+    and sparse min/max tables built on first use, so each query is a pair of binary searches.
+    Windows are inclusive at both ends, like average_glucose. Only the last WINDOW_RESULTS
+    per-window results are kept, and nbytes counts everything kept.
+    """
+    __slots__ = ("times", "values", "_derived", "_windows")
+
+    def __init__(self, times, values):
+        self.times, self.values = _sorted_unique(np.asarray(times, dtype=np.int64),
+                                                 np.asarray(values, dtype=np.float64))
+        self._derived = {}
+        self._windows = OrderedDict()
+
+    @classmethod
+    def from_records(cls, data):
+        times = TimeColumn(timestampvariable("entries"))
+        values = array('d')
+        for entry in data:
+            if 'sgv' in entry:
+                times.append(entry)
+                values.append(entry['sgv'] / MGDL_PER_MMOL)  # convert to mmol/L
+        instrumentation.count("parsed.entries", len(values))
+        return cls(times.finish(), np.frombuffer(values, dtype=np.float64))
+
+    def __len__(self):
+        return len(self.times)
+
+    @classmethod
+    def _from_sorted(cls, times, values):
+        series = cls.__new__(cls)
+        series.times, series.values = times, values
+        series._derived = {}
+        series._windows = OrderedDict()
+        return series
+
+    def window(self, start: datetime, end: datetime):
+        """Readings with start <= time <= end, as views on the same columns."""
+        lo = np.searchsorted(self.times, datetime_ms(start), side='left')
+        hi = np.searchsorted(self.times, datetime_ms(end), side='right')
+        return self._from_sorted(self.times[lo:hi], self.values[lo:hi])
+
+    def merged(self, other):
+        """Union with another series; readings in `other` win on equal timestamps."""
+        return GlucoseSeries(np.concatenate([self.times, other.times]), np.concatenate([self.values, other.values]))
+
+    @property
+    def nbytes(self) -> int:
+        with _WINDOWS_LOCK:
+            kept = list(self._derived.values()) + list(self._windows.values())
+        return self.times.nbytes + self.values.nbytes + sum(held_bytes(value) for value in kept)
+
+    def _derive(self, key, build):
+        if key not in self._derived:
+            self._derived[key] = build()
+        return self._derived[key]
+
+    def _derive_window(self, key, build):
+        # like _derive, for results of one window, of which only the last WINDOW_RESULTS are kept
+        with _WINDOWS_LOCK:
+            if key in self._windows:
+                self._windows.move_to_end(key)
+                return self._windows[key]
+        value = build()
+        with _WINDOWS_LOCK:
+            self._windows[key] = value
+            while len(self._windows) > WINDOW_RESULTS:
+                self._windows.popitem(last=False)
+        return value
+
+    def _span(self, start: datetime, end: datetime):
+        return (int(np.searchsorted(self.times, datetime_ms(start), side='left')),
+                int(np.searchsorted(self.times, datetime_ms(end), side='right')))
+
+    def _sums(self):
+        # prefix sums of values and squares, shifted by the overall mean to keep the variance accurate
+        def build():
+            shift = float(self.values.mean()) if len(self.values) else 0.0
+            centred = self.values - shift
+            return (shift, np.concatenate([[0.0], np.cumsum(centred)]),
+                    np.concatenate([[0.0], np.cumsum(centred * centred)]))
+        return self._derive("sums", build)
+
+    def _extreme(self, lo: int, hi: int, reduce):
+        # sparse table: level k holds the min/max of each run of 2**k readings
+        def build():
+            levels = [self.values]
+            while 2 ** len(levels) <= len(self.values):
+                previous, half = levels[-1], 2 ** (len(levels) - 1)
+                levels.append(reduce(previous[:-half], previous[half:]))
+            return levels
+        if hi <= lo:
+            return None
+        levels = self._derive(reduce.__name__, build)
+        k = (hi - lo).bit_length() - 1
+        return float(reduce(levels[k][lo], levels[k][hi - 2 ** k]))
+
+    def count(self, start: datetime, end: datetime) -> int:
+        lo, hi = self._span(start, end)
+        return hi - lo
+
+    def mean(self, start: datetime, end: datetime):
+        lo, hi = self._span(start, end)
+        if hi <= lo:
+            return None
+        shift, sums, _ = self._sums()
+        return shift + float(sums[hi] - sums[lo]) / (hi - lo)
+
+    def sd(self, start: datetime, end: datetime):
+        """Sample standard deviation, or None with fewer than two readings."""
+        lo, hi = self._span(start, end)
+        n = hi - lo
+        if n < 2:
+            return None
+        _, sums, squares = self._sums()
+        total = sums[hi] - sums[lo]
+        return float(np.sqrt(max(squares[hi] - squares[lo] - total * total / n, 0.0) / (n - 1)))
+
+    def min(self, start: datetime, end: datetime):
+        return self._extreme(*self._span(start, end), np.minimum)
+
+    def max(self, start: datetime, end: datetime):
+        return self._extreme(*self._span(start, end), np.maximum)
+
+    def time_in_range(self, start: datetime, end: datetime, low: float = TARGET_LOW, high: float = TARGET_HIGH):
+        """Percent of readings with low <= value <= high (mmol/L)."""
+        lo, hi = self._span(start, end)
+        if hi <= lo:
+            return None
+        inside = self._derive(("in range", low, high), lambda: np.concatenate(
+            [[0], np.cumsum((self.values >= low) & (self.values <= high))]))
+        return float(inside[hi] - inside[lo]) / (hi - lo) * 100
+
+    def gmi(self, start: datetime, end: datetime):
+        """Glucose management indicator (%), from the mean in mg/dL."""
+        mean = self.mean(start, end)
+        return None if mean is None else 3.31 + 0.02392 * mean * MGDL_PER_MMOL
+
+    def stats(self, start: datetime, end: datetime, low: float = TARGET_LOW, high: float = TARGET_HIGH) -> dict:
+        return {
+            'count': self.count(start, end), 'mean': self.mean(start, end), 'sd': self.sd(start, end),
+            'min': self.min(start, end), 'max': self.max(start, end),
+            'time_in_range': self.time_in_range(start, end, low, high), 'gmi': self.gmi(start, end),
+        }
+
+    def interval_means(self, start: datetime, end: datetime, minutes: int):
+        """
+        Mean of each epoch-aligned interval of the window as a Series indexed by the interval's
+        (UTC) right edge, NaN where there are no readings. Recent windows are kept, so the plot and
+        tables share the result.
+        """
+        import pandas as pd
+
+        def build():
+            interval = minutes * 60_000
+            first = datetime_ms(start) // interval * interval
+            last = datetime_ms(end) // interval * interval
+            edges = first + interval * np.arange(1, (last - first) // interval + 1, dtype=np.int64)
+            index = np.concatenate([[self._span(start, start)[0]],
+                                    np.searchsorted(self.times, edges, side='left'),
+                                    [self._span(end, end)[1]]])
+            shift, sums, _ = self._sums()
+            counts = np.diff(index)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                means = shift + np.diff(sums[index]) / counts
+            labels = np.append(edges, last + interval)
+            return pd.Series(np.where(counts > 0, means, np.nan),
+                             index=pd.to_datetime(labels, unit='ms', utc=True), name='glucose')
+        return self._derive_window(("interval means", start, end, minutes), build)
+
+    def todict(self) -> dict:
+        return {ms_to_datetime(ms): value for ms, value in zip(self.times.tolist(), self.values.tolist())}
+
+
+class TempBasals:
+    """Temp basals: int64 epoch-ms `starts` (ascending), float64 `durations` in minutes and `rates` in U/h."""
+    __slots__ = ("starts", "durations", "rates")
+
+    def __init__(self, starts, durations, rates):
+        self.starts, self.durations, self.rates = _sorted_unique(np.asarray(starts, dtype=np.int64),
+                                                                 np.asarray(durations, dtype=np.float64),
+                                                                 np.asarray(rates, dtype=np.float64))
+
+    def __len__(self):
+        return len(self.starts)
+
+    def arrays(self):
+        """(starts_ms, ends_ms, rates) as used by columnarcalculator."""
+        return self.starts, self.starts + (self.durations * 60_000).astype(np.int64), self.rates
+
+    def merged(self, other):
+        return TempBasals(np.concatenate([self.starts, other.starts]),
+                          np.concatenate([self.durations, other.durations]),
+                          np.concatenate([self.rates, other.rates]))
+
+    @property
+    def nbytes(self) -> int:
+        return self.starts.nbytes + self.durations.nbytes + self.rates.nbytes
+
+    def todict(self) -> dict:
+        return {ms_to_datetime(ms): {"rate": rate, "duration": duration}
+                for ms, duration, rate in zip(self.starts.tolist(), self.durations.tolist(), self.rates.tolist())}
+
+
+class Boluses:
+    """Boluses: int64 epoch-ms `times` (ascending) and float64 `units`."""
+    __slots__ = ("times", "units")
+
+    def __init__(self, times, units):
+        self.times, self.units = _sorted_unique(np.asarray(times, dtype=np.int64),
+                                                np.asarray(units, dtype=np.float64))
+
+    def __len__(self):
+        return len(self.times)
+
+    def arrays(self):
+        return self.times, self.units
+
+    def merged(self, other):
+        return Boluses(np.concatenate([self.times, other.times]), np.concatenate([self.units, other.units]))
+
+    @property
+    def nbytes(self) -> int:
+        return self.times.nbytes + self.units.nbytes
+
+    def todict(self) -> dict:
+        return {ms_to_datetime(ms): units for ms, units in zip(self.times.tolist(), self.units.tolist())}
+
+
+def parse_treatments(treatments):
+    """Single-pass equivalent of treatmentinsulin.treatmenttimes returning (TempBasals, Boluses)."""
+    field = timestampvariable("treatments")
+    temp_starts, temp_durations, temp_rates = TimeColumn(field), array('d'), array('d')
+    bolus_times, bolus_units = TimeColumn(field), array('d')
+    for n in treatments:
+        if n["eventType"] == "Temp Basal":
+            temp_starts.append(n)
+            temp_durations.append(n["duration"])
+            temp_rates.append(n["rate"])
+        elif n["eventType"] == "Suspend Pump":
+            temp_starts.append(n)
+            temp_durations.append(30)  # no duration provided
+            temp_rates.append(0)
+        elif float(n["insulin"] or 0) > 0:
+            bolus_times.append(n)
+            bolus_units.append(float(n["insulin"]))
+    instrumentation.count("parsed.temp_basals", len(temp_durations))
+    instrumentation.count("parsed.boluses", len(bolus_units))
+    return (TempBasals(temp_starts.finish(), np.frombuffer(temp_durations), np.frombuffer(temp_rates)),
+            Boluses(bolus_times.finish(), np.frombuffer(bolus_units)))
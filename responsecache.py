@@ -0,0 +1,211 @@
+"""
+Persistent on-disk cache of Nightscout records.
+
+Records are stored per NSID and collection in SQLite together with the time intervals that have
+already been downloaded, so a request only goes to the network for the gaps it has not seen.
+Historical data never changes; intervals that reach close to the time they were fetched are
+treated as mutable and re-downloaded once they are older than `ttl`.
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from urlformater import timestampvariable
+
+DEFAULT_PATH = os.path.join(os.path.expanduser("~"), ".cache", "insulinquantification", "nightscout.sqlite")
+# Seconds a write waits for another process (e.g. a cohort worker) holding the database lock
+BUSY_TIMEOUT = 30
+# Cached records read per query while streaming a range
+READ_BATCH = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    nsid TEXT NOT NULL,
+    collection TEXT NOT NULL,
+    ts TEXT NOT NULL,
+    id TEXT NOT NULL,
+    body TEXT NOT NULL,
+    PRIMARY KEY (nsid, collection, id)
+);
+CREATE INDEX IF NOT EXISTS records_by_time ON records (nsid, collection, ts);
+CREATE TABLE IF NOT EXISTS intervals (
+    nsid TEXT NOT NULL,
+    collection TEXT NOT NULL,
+    start TEXT NOT NULL,
+    end TEXT NOT NULL,
+    fetched_at REAL NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS intervals_by_range ON intervals (nsid, collection, start);
+"""
+
+
+def subtract_intervals(start: str, end: str, covered: list) -> list:
+    """Return the parts of [start, end] not inside any of the sorted `covered` (start, end) pairs."""
+    gaps = []
+    cursor = start
+    for lo, hi in covered:
+        if hi < cursor:
+            continue
+        if lo > end:
+            break
+        if lo > cursor:
+            gaps.append((cursor, lo))
+        cursor = max(cursor, hi)
+        if cursor >= end:
+            return gaps
+    if cursor < end:
+        gaps.append((cursor, end))
+    return gaps
+
+
+class ResponseCache:
+    def __init__(self, path: str = DEFAULT_PATH, *, ttl: timedelta = timedelta(hours=1),
+                 settle: timedelta = timedelta(days=1), max_idle: timedelta = timedelta(days=30),
+                 max_bytes: int = 512 * 1024 * 1024):
+        """
+        ttl       how long an interval that may still receive uploads stays valid
+        settle    how far behind its fetch time an interval must end to count as immutable
+        max_idle  intervals not used for this long are evicted
+        max_bytes size cap; least recently used intervals are evicted past it
+        """
+        self.path = path
+        self.ttl = ttl
+        self.settle = settle
+        self.max_idle = max_idle
+        self.max_bytes = max_bytes
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=BUSY_TIMEOUT, check_same_thread=False)
+        with self._lock, self._db:
+            self._db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            # readers don't block the writer, so several processes can share one file
+            self._db.execute("PRAGMA journal_mode = WAL")
+            self._db.execute(f"PRAGMA busy_timeout = {BUSY_TIMEOUT * 1000}")
+            self._db.executescript(SCHEMA)
+
+    def records(self, nsid: str, collection: str, startDate: str, endDate: str, fetch):
+        """
+        Yield the cached records of [startDate, endDate] newest first, first calling
+        fetch(gapStart, gapEnd) -> iterable of pages for each part of the range not yet on disk.
+        """
+        timestamp = timestampvariable(collection)
+        for gapStart, gapEnd in self.missing(nsid, collection, startDate, endDate):
+            fetched_at = time.time()
+            for page in fetch(gapStart, gapEnd):
+                self._store(nsid, collection, timestamp, page)
+            self._cover(nsid, collection, gapStart, gapEnd, fetched_at)
+
+        with self._lock, self._db:
+            self._db.execute(
+                "UPDATE intervals SET last_used = ? WHERE nsid = ? AND collection = ? AND start <= ? AND end >= ?",
+                (time.time(), nsid, collection, endDate, startDate),
+            )
+        # read in batches, each continuing below the last row, so neither the range nor the lock is held
+        last = (endDate, None)
+        while True:
+            with self._lock:
+                rows = self._db.execute(
+                    "SELECT ts, id, body FROM records WHERE nsid = ? AND collection = ? AND ts >= ? "
+                    "AND (ts < ? OR (ts = ? AND (? IS NULL OR id < ?))) ORDER BY ts DESC, id DESC LIMIT ?",
+                    (nsid, collection, startDate, last[0], last[0], last[1], last[1], READ_BATCH),
+                ).fetchall()
+            for _, _, body in rows:
+                yield json.loads(body)
+            if len(rows) < READ_BATCH:
+                break
+            last = rows[-1][:2]
+        # evict only after reading so the interval just downloaded is served at least once
+        self._evict()
+
+    def missing(self, nsid: str, collection: str, startDate: str, endDate: str) -> list:
+        """The sub-ranges of [startDate, endDate] that would have to be downloaded."""
+        self._expire(nsid, collection)
+        with self._lock:
+            covered = self._db.execute(
+                "SELECT start, end FROM intervals WHERE nsid = ? AND collection = ? AND start <= ? AND end >= ? "
+                "ORDER BY start",
+                (nsid, collection, endDate, startDate),
+            ).fetchall()
+        return subtract_intervals(startDate, endDate, covered)
+
+    def _store(self, nsid, collection, timestamp, page):
+        rows = []
+        for record in page:
+            body = json.dumps(record, separators=(",", ":"))
+            rows.append((nsid, collection, record[timestamp], record.get("_id") or body, body))
+        with self._lock, self._db:
+            self._db.executemany("INSERT OR REPLACE INTO records VALUES (?, ?, ?, ?, ?)", rows)
+
+    def _cover(self, nsid, collection, start, end, fetched_at):
+        # merge with every interval it touches so lookups stay short
+        with self._lock, self._db:
+            touching = self._db.execute(
+                "SELECT rowid, start, end, fetched_at FROM intervals "
+                "WHERE nsid = ? AND collection = ? AND start <= ? AND end >= ?",
+                (nsid, collection, end, start),
+            ).fetchall()
+            for rowid, lo, hi, other_fetched_at in touching:
+                start, end = min(start, lo), max(end, hi)
+                fetched_at = min(fetched_at, other_fetched_at)
+                self._db.execute("DELETE FROM intervals WHERE rowid = ?", (rowid,))
+            self._db.execute(
+                "INSERT INTO intervals VALUES (?, ?, ?, ?, ?, ?)",
+                (nsid, collection, start, end, fetched_at, time.time()),
+            )
+
+    def _expire(self, nsid, collection):
+        now = time.time()
+        with self._lock, self._db:
+            for rowid, end, fetched_at in self._db.execute(
+                    "SELECT rowid, end, fetched_at FROM intervals WHERE nsid = ? AND collection = ? AND fetched_at < ?",
+                    (nsid, collection, now - self.ttl.total_seconds())).fetchall():
+                fetched = datetime.fromtimestamp(fetched_at, timezone.utc).replace(tzinfo=None)
+                if datetime.fromisoformat(end) > fetched - self.settle:
+                    # data may have been uploaded since; the records stay and are overwritten on re-fetch
+                    self._db.execute("DELETE FROM intervals WHERE rowid = ?", (rowid,))
+
+    def _evict(self):
+        with self._lock, self._db:
+            for nsid, collection, start, end in self._db.execute(
+                    "SELECT nsid, collection, start, end FROM intervals WHERE last_used < ?",
+                    (time.time() - self.max_idle.total_seconds(),)).fetchall():
+                self._drop(nsid, collection, start, end)
+
+            while self.size() > self.max_bytes:
+                oldest = self._db.execute(
+                    "SELECT nsid, collection, start, end FROM intervals ORDER BY last_used LIMIT 1").fetchone()
+                if oldest is None:
+                    break
+                self._drop(*oldest)
+                self._db.commit()
+                self._db.execute("PRAGMA incremental_vacuum").fetchall()
+
+    def _drop(self, nsid, collection, start, end):
+        self._db.execute("DELETE FROM intervals WHERE nsid = ? AND collection = ? AND start = ? AND end = ?",
+                         (nsid, collection, start, end))
+        self._db.execute("DELETE FROM records WHERE nsid = ? AND collection = ? AND ts >= ? AND ts <= ?",
+                         (nsid, collection, start, end))
+
+    def size(self) -> int:
+        """Bytes in use by the database file, excluding free pages."""
+        page_count = self._db.execute("PRAGMA page_count").fetchone()[0]
+        free_pages = self._db.execute("PRAGMA freelist_count").fetchone()[0]
+        page_size = self._db.execute("PRAGMA page_size").fetchone()[0]
+        return (page_count - free_pages) * page_size
+
+    def clear(self, nsid: str = None):
+        with self._lock, self._db:
+            if nsid is None:
+                self._db.execute("DELETE FROM records")
+                self._db.execute("DELETE FROM intervals")
+            else:
+                self._db.execute("DELETE FROM records WHERE nsid = ?", (nsid,))
+                self._db.execute("DELETE FROM intervals WHERE nsid = ?", (nsid,))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
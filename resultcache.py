@@ -0,0 +1,257 @@
+"""
+Memoized per-window results for repeated runs over overlapping windows (e.g. Streamlit re-submits).
+
+Raw fetched data and computed deliveries are cached separately, each in a memory-bounded LRU:
+
+* raw data per NSID covers one contiguous UTC range and grows when a request extends it, fetching
+  only the missing head/tail; every growth bumps the NSID's data version. A window that is
+  evicted or replaced by a disjoint one is downloaded again under a still higher version, and the
+  deliveries computed from the old download are dropped.
+* deliveries are keyed by (nsid, start, end, data version). When a window is extended at the end
+  and nothing before the old end changed, only the new tail is integrated and added to the cached
+  prefix.
+
+Data near the time it was fetched can still receive uploads, so the part of a raw range within
+`settle` of its fetch time is re-fetched once it is older than `ttl`.
+
+The lock is held only to read and update the caches. Downloads happen outside it, so sessions
+working on different NSIDs don't wait for each other. Requests for an NSID that is already
+downloading wait for that download and then reuse it.
+"""
+import copy
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+
+import pandas as pd
+
+import instrumentation
+from basalinsulin import latestprofiles, PROFILE_INDEX
+from basalschedule import BasalSchedule
+from columnarcalculator import columnar_insulin_delivery
+from dataretriever import fetchConcurrently
+from glucosereadings import glucosereadings
+from treatmentinsulin import treatmentinsulin
+from urlformater import PAGE_SIZE
+
+
+def naive(when: datetime) -> str:
+    return when.astimezone(timezone.utc).replace(tzinfo=None).isoformat(timespec="seconds")
+
+
+def sizeof(value) -> int:
+    """Approximate bytes held by a cached value."""
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    if hasattr(value, "nbytes"):
+        return value.nbytes
+    if isinstance(value, (bytes, str)):
+        return len(value)
+    if isinstance(value, RawWindow):
+        return sum(sizeof(part) for part in (value.temps, value.boluses, value.glucose)) + 1024 * len(value.profiles)
+    if isinstance(value, tuple):
+        return sum(sizeof(part) for part in value)
+    return 64
+
+
+class LRUCache:
+    """Least recently used eviction once the summed sizeof() of the values passes max_bytes."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.total = 0
+        self._items = OrderedDict()  # key -> (value, size)
+
+    def get(self, key):
+        if key not in self._items:
+            return None
+        self._items.move_to_end(key)
+        return self._items[key][0]
+
+    def put(self, key, value):
+        self.pop(key)
+        size = sizeof(value)
+        self._items[key] = (value, size)
+        self.total += size
+        while self.total > self.max_bytes and len(self._items) > 1:
+            _, (_, evicted) = self._items.popitem(last=False)
+            self.total -= evicted
+
+    def pop(self, key):
+        if key in self._items:
+            self.total -= self._items.pop(key)[1]
+
+    def keys(self):
+        return list(self._items)
+
+
+class RawWindow:
+    __slots__ = ("start", "end", "fetched_at", "version", "changes", "profiles", "temps", "boluses", "glucose")
+
+    def __init__(self, start, end, fetched, version=1):
+        self.start, self.end = start, end
+        self.fetched_at = time.time()
+        self.version = version
+        self.changes = []  # (version, earliest time whose data changed in that version)
+        self.profiles, (self.temps, self.boluses), self.glucose = fetched
+
+    def schedule(self, end: datetime) -> BasalSchedule:
+        return BasalSchedule(self.profiles, naive(end))
+
+    def unchanged_before(self, version: int, until: datetime) -> bool:
+        """True if no data before `until` changed after `version`."""
+        return all(changed_from >= until for changed, changed_from in self.changes if changed > version)
+
+
+class WindowCache:
+    def __init__(self, *, max_raw_bytes: int = 256 * 2 ** 20, max_result_bytes: int = 64 * 2 ** 20,
+                 ttl: timedelta = timedelta(minutes=5), settle: timedelta = timedelta(days=1),
+                 interval_minutes: int = 60, glucose_shards: int = 1):
+        self.raw = LRUCache(max_raw_bytes)
+        self.results = LRUCache(max_result_bytes)
+        self.ttl = ttl
+        self.settle = settle
+        self.interval_minutes = interval_minutes
+        self.glucose_shards = glucose_shards
+        # guards the caches only; downloads run outside it, one at a time per NSID
+        self._lock = threading.Lock()
+        self._inflight = {}  # nsid -> Event set when its download has been merged
+        # nsid -> latest data version; never goes back, even when the raw window is evicted or replaced
+        self._versions = {}
+
+    def _fetch(self, nsid: str, start: datetime, end: datetime):
+        startdate, enddate = naive(start), naive(end)
+        fetched = fetchConcurrently({
+            "profiles": (latestprofiles, nsid, startdate, enddate),
+            "treatments": (treatmentinsulin, nsid, startdate, enddate, PAGE_SIZE, 1, True),
+            "glucose": (glucosereadings, nsid, startdate, enddate, PAGE_SIZE, self.glucose_shards, True),
+        })
+        PROFILE_INDEX.add(nsid, fetched["profiles"])
+        return fetched["profiles"], fetched["treatments"], fetched["glucose"]
+
+    def data(self, nsid: str, start: datetime, end: datetime) -> RawWindow:
+        """
+        Raw data covering [start, end], fetching only what the cached range is missing. Returns a
+        snapshot, so the caller can keep reading it while another request grows the cached window.
+        """
+        while True:
+            with self._lock:
+                pending = self._inflight.get(nsid)
+                if pending is None:
+                    window, ranges = self._missing(nsid, start, end)
+                    if not ranges:
+                        self._store(nsid, window)
+                        return copy.copy(window)
+                    pending = self._inflight[nsid] = threading.Event()
+                    break
+            # another request is downloading this NSID; look again once its data is merged
+            pending.wait()
+
+        try:
+            fetched = [self._fetch(nsid, lo, hi) for lo, hi in ranges]
+            with self._lock:
+                if window is None or end < window.start or start > window.end:
+                    window = RawWindow(start, end, fetched[0], self._versions.get(nsid, 0))
+                    # a new download: nothing computed from an earlier one is a valid prefix
+                    self._changed(window, start)
+                    self._forget(nsid)
+                else:
+                    for (lo, hi), data in zip(ranges, fetched):
+                        self._merge(window, data)
+                        if lo < window.start:
+                            self._changed(window, lo)
+                            window.start = lo
+                        else:
+                            self._changed(window, window.end)
+                            window.end = hi
+                            window.fetched_at = time.time()
+                self._store(nsid, window)
+                return copy.copy(window)
+        finally:
+            with self._lock:
+                del self._inflight[nsid]
+            pending.set()
+
+    def _store(self, nsid: str, window: RawWindow):
+        self._versions[nsid] = window.version
+        self.raw.put(nsid, window)
+
+    def _forget(self, nsid: str):
+        for key in self.results.keys():
+            if key[0] == nsid:
+                self.results.pop(key)
+
+    def _missing(self, nsid: str, start: datetime, end: datetime):
+        # (cached window or None, ranges to fetch); the whole of [start, end] when it can't be extended
+        window = self.raw.get(nsid)
+        if window is not None:
+            fetched_at = datetime.fromtimestamp(window.fetched_at, timezone.utc)
+            if time.time() - window.fetched_at > self.ttl.total_seconds() and window.end > fetched_at - self.settle:
+                # the recent part may have gained uploads; treat it as not fetched
+                window.end = max(window.start, fetched_at - self.settle)
+                window.fetched_at = time.time()
+                self._changed(window, window.end)
+
+        if window is None or end < window.start or start > window.end:
+            return window, [(start, end)]
+        ranges = []
+        if start < window.start:
+            ranges.append((start, window.start))
+        if end > window.end:
+            ranges.append((window.end, end))
+        return window, ranges
+
+    def _merge(self, window: RawWindow, fetched):
+        profiles, (temps, boluses), glucose = fetched
+        window.profiles = {**window.profiles, **profiles}
+        window.temps = window.temps.merged(temps)
+        window.boluses = window.boluses.merged(boluses)
+        window.glucose = window.glucose.merged(glucose)
+
+    def _changed(self, window: RawWindow, changed_from: datetime):
+        window.version += 1
+        window.changes.append((window.version, changed_from))
+
+    def delivery(self, nsid: str, start: datetime, end: datetime):
+        """(basal, bolus, per-interval DataFrame) for [start, end), reusing a cached prefix when possible."""
+        window = self.data(nsid, start, end)
+        key = (nsid, start, end, window.version)
+        with self._lock:
+            cached = self.results.get(key)
+            prefix = self._prefix(window, nsid, start, end) if cached is None else None
+        if cached is not None:
+            instrumentation.count("resultcache.hits")
+            return cached
+
+        schedule = window.schedule(end)
+        instrumentation.count("resultcache.misses" if prefix is None else "resultcache.extensions")
+        if prefix is None:
+            result = columnar_insulin_delivery(schedule, window.temps, window.boluses, start, end,
+                                               self.interval_minutes)
+        else:
+            prefix_end, (basal, bolus, delivery) = prefix
+            tail_basal, tail_bolus, tail = columnar_insulin_delivery(schedule, window.temps, window.boluses,
+                                                                     prefix_end, end, self.interval_minutes)
+            # the interval straddling the old end appears in both and is summed
+            delivery = pd.concat([delivery, tail])[['basal', 'bolus']].groupby(level=0).sum()
+            basal, bolus = basal + tail_basal, bolus + tail_bolus
+            total = basal + bolus
+            delivery['percent'] = (delivery['basal'] + delivery['bolus']) / total * 100 if total > 0 else 0.0
+            result = (basal, bolus, delivery)
+
+        with self._lock:
+            self.results.put(key, result)
+        return result
+
+    def _prefix(self, window: RawWindow, nsid: str, start: datetime, end: datetime):
+        # the longest cached result for the same start that the new window extends
+        best = None
+        for cached_nsid, cached_start, cached_end, version in self.results.keys():
+            if (cached_nsid, cached_start) != (nsid, start) or cached_end > end:
+                continue
+            if not window.unchanged_before(version, cached_end):
+                continue
+            if best is None or cached_end > best[0]:
+                best = (cached_end, self.results.get((cached_nsid, cached_start, cached_end, version)))
+        return best
@@ -0,0 +1,207 @@
+"""
+Columnar export of a run's inputs and results for analysis elsewhere.
+
+Five tables, each partitioned by NSID and UTC date (Hive-style, so pyarrow.dataset, DuckDB and
+Spark read a table directory as one dataset):
+
+    <root>/<table>/nsid=<nsid>/date=<YYYY-MM-DD>/part-0.<parquet|arrow|csv>
+
+* delivery: interval_start, interval_end, basal, bolus, percent (and iob, activity when computed)
+* glucose: time, mmol
+* temp_basals: start, duration_minutes, rate
+* boluses: time, units
+* basal_schedule: time, rate, for every scheduled rate change
+
+Timestamps are epoch milliseconds, typed timestamp[ms, UTC] in Parquet/Arrow and written as ISO
+strings in CSV. Parquet and Arrow IPC need pyarrow, which is imported only when one of them is
+written; format=None picks Parquet when it is installed and CSV otherwise. Partitions are sliced
+from the in-memory columns and written one at a time, so only one day of one table is converted
+at once. Exporting a range rewrites the partitions of the days it touches.
+"""
+import csv
+import io
+import os
+import zipfile
+
+import numpy as np
+
+import instrumentation
+from records import datetime_ms
+
+FORMATS = ("parquet", "arrow", "csv")
+TABLES = ("delivery", "glucose", "temp_basals", "boluses", "basal_schedule")
+MS_PER_DAY = 86_400_000
+# columns holding epoch milliseconds
+TIMESTAMP_COLUMNS = frozenset(("interval_start", "interval_end", "time", "start"))
+
+
+def default_format() -> str:
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return "csv"
+    return "parquet"
+
+
+def delivery_columns(delivery, interval_minutes: int = 60) -> dict:
+    """Columns of the per-interval DataFrame or hourly dict from calculate_insulin_delivery."""
+    if hasattr(delivery, "index"):
+        ends = delivery.index.as_unit("ms").asi8
+        values = {name: delivery[name].to_numpy(dtype=float) for name in delivery.columns}
+    else:
+        times = sorted(delivery)
+        ends = np.array([datetime_ms(time) for time in times], dtype=np.int64)
+        names = list(delivery[times[0]]) if times else ['basal', 'bolus', 'percent']
+        values = {name: np.array([delivery[time].get(name, np.nan) for time in times], dtype=float) for name in names}
+    return {"interval_start": ends - interval_minutes * 60_000, "interval_end": ends, **values}
+
+
+def glucose_columns(glucose) -> dict:
+    """Columns of a records.GlucoseSeries or the {datetime: mmol/L} dict."""
+    if hasattr(glucose, "times"):
+        return {"time": glucose.times, "mmol": glucose.values}
+    times = sorted(glucose)
+    return {"time": np.array([datetime_ms(time) for time in times], dtype=np.int64),
+            "mmol": np.array([glucose[time] for time in times], dtype=float)}
+
+
+def temp_columns(temps) -> dict:
+    """Columns of records.TempBasals or the treatmenttimes temp basal dict."""
+    if hasattr(temps, "starts"):
+        return {"start": temps.starts, "duration_minutes": temps.durations, "rate": temps.rates}
+    starts = sorted(temps)
+    return {"start": np.array([datetime_ms(start) for start in starts], dtype=np.int64),
+            "duration_minutes": np.array([temps[start]['duration'] for start in starts], dtype=float),
+            "rate": np.array([temps[start]['rate'] for start in starts], dtype=float)}
+
+
+def bolus_columns(boluses) -> dict:
+    """Columns of records.Boluses or the treatmenttimes bolus dict."""
+    if hasattr(boluses, "units"):
+        return {"time": boluses.times, "units": boluses.units}
+    times = sorted(boluses)
+    return {"time": np.array([datetime_ms(time) for time in times], dtype=np.int64),
+            "units": np.array([float(boluses[time]) for time in times], dtype=float)}
+
+
+def schedule_columns(schedule, start=None, end=None) -> dict:
+    """Rate changes of a basalschedule.BasalSchedule over [start, end), or of the {time: rate} dict."""
+    changes = schedule.todict(start, end) if hasattr(schedule, "todict") else schedule
+    times = sorted(changes)
+    return {"time": np.array([datetime_ms(time) for time in times], dtype=np.int64),
+            "rate": np.array([changes[time] for time in times], dtype=float)}
+
+
+def clip(columns: dict, start_ms, end_ms, on: str = None) -> dict:
+    """Rows whose `on` column (by default the first) is in [start_ms, end_ms), sorted by it."""
+    on = on or next(iter(columns))
+    key = columns[on]
+    if len(key) > 1 and (np.diff(key) < 0).any():
+        order = np.argsort(key, kind="stable")
+        columns = {name: values[order] for name, values in columns.items()}
+        key = columns[on]
+    lo = 0 if start_ms is None else np.searchsorted(key, start_ms, side='left')
+    hi = len(key) if end_ms is None else np.searchsorted(key, end_ms, side='left')
+    return {name: values[lo:hi] for name, values in columns.items()}
+
+
+def days(columns: dict):
+    """Yield (YYYY-MM-DD, columns of that UTC day) in date order; columns are sorted by the first."""
+    key = next(iter(columns.values()))
+    day_numbers = key // MS_PER_DAY
+    bounds = np.flatnonzero(np.diff(day_numbers)) + 1
+    for lo, hi in zip(np.concatenate([[0], bounds]), np.concatenate([bounds, [len(key)]])):
+        if hi > lo:
+            day = np.datetime_as_string(np.datetime64(int(day_numbers[lo]), 'D'))
+            yield day, {name: values[lo:hi] for name, values in columns.items()}
+
+
+def write_csv(columns: dict, sink):
+    text = io.TextIOWrapper(sink, encoding="utf-8", newline="")
+    writer = csv.writer(text)
+    writer.writerow(columns)
+    rows = [np.char.add(np.datetime_as_string(values.astype("datetime64[ms]"), unit="ms"), "Z").tolist()
+            if name in TIMESTAMP_COLUMNS else values.tolist() for name, values in columns.items()]
+    writer.writerows(zip(*rows))
+    text.flush()
+    text.detach()
+
+
+def write_arrow(columns: dict, sink, format: str):
+    import pyarrow as pa
+    table = pa.table({
+        name: pa.array(values, type=pa.timestamp("ms", tz="UTC") if name in TIMESTAMP_COLUMNS else pa.float64())
+        for name, values in columns.items()
+    })
+    if format == "parquet":
+        import pyarrow.parquet as pq
+        pq.write_table(table, sink)
+    else:
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+
+
+def write_partition(columns: dict, sink, format: str):
+    """Write one partition to a binary file object."""
+    if format == "csv":
+        write_csv(columns, sink)
+    elif format in ("parquet", "arrow"):
+        write_arrow(columns, sink, format)
+    else:
+        raise ValueError(f"Unknown export format {format!r}, expected one of {FORMATS}")
+
+
+def partitions(nsid: str, format: str, *, delivery=None, glucose=None, temps=None, boluses=None, schedule=None,
+               start=None, end=None, interval_minutes: int = 60):
+    """Yield (relative path, table, columns) for every partition of the tables given."""
+    start_ms = None if start is None else datetime_ms(start)
+    end_ms = None if end is None else datetime_ms(end)
+    sources = {
+        "delivery": (delivery, lambda: delivery_columns(delivery, interval_minutes)),
+        "glucose": (glucose, lambda: glucose_columns(glucose)),
+        "temp_basals": (temps, lambda: temp_columns(temps)),
+        "boluses": (boluses, lambda: bolus_columns(boluses)),
+        "basal_schedule": (schedule, lambda: schedule_columns(schedule, start, end)),
+    }
+    for table in TABLES:
+        source, columns = sources[table]
+        if source is None:
+            continue
+        if table == "delivery":
+            # every interval overlapping [start, end), including partial first and last ones
+            part = clip(clip(columns(), None if start_ms is None else start_ms + 1, None, on="interval_end"),
+                        None, end_ms)
+        else:
+            part = clip(columns(), start_ms, end_ms)
+        for day, part in days(part):
+            yield "/".join((table, f"nsid={nsid}", f"date={day}", "part-0." + format)), table, part
+
+
+def export_results(root: str, nsid: str, *, format: str = None, **tables) -> list:
+    """
+    Write the given tables (delivery=, glucose=, temps=, boluses=, schedule=, optionally limited to
+    start=/end=) under `root`; returns the paths written.
+    """
+    format = format or default_format()
+    written = []
+    for path, table, columns in partitions(nsid, format, **tables):
+        with instrumentation.stage("export." + table):
+            path = os.path.join(root, *path.split("/"))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                write_partition(columns, f, format)
+        instrumentation.count("export.rows", len(next(iter(columns.values()))))
+        written.append(path)
+    return written
+
+
+def export_zip(nsid: str, *, format: str = None, **tables) -> bytes:
+    """export_results laid out inside a zip archive, e.g. for a download button."""
+    format = format or default_format()
+    out = io.BytesIO()
+    with zipfile.ZipFile(out, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for path, table, columns in partitions(nsid, format, **tables):
+            with instrumentation.stage("export." + table), archive.open(path, "w") as f:
+                write_partition(columns, f, format)
+            instrumentation.count("export.rows", len(next(iter(columns.values()))))
+    return out.getvalue()
@@ -0,0 +1,198 @@
+"""
+Local stand-in for the Nightscout v1 API.
+
+Serves /<nsid>/api/v1/{entries,treatments,profiles}.json from in-memory patients (for example from
+synthetic.synthetic_patient) with the same find[...] / count query semantics the fetchers rely on:
+string range comparisons on the collection's timestamp field, newest first, at most `count` rows.
+Responses are gzipped for clients that accept them, unless the server is built with compress=False.
+For exercising the fetch scheduler it can add latency per request and per returned record, and fail
+a fraction of requests with e.g. 503 or 429 plus an optional Retry-After.
+Point the fetchers at it with urlformater.BASE_URL = server.url (or the NIGHTSCOUT_URL variable).
+"""
+import gzip
+import json
+import random
+import threading
+import time
+from bisect import bisect_left, bisect_right
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qsl
+
+from urlformater import timestampvariable
+
+DEFAULT_COUNT = 10  # what Nightscout returns when no count is given
+
+
+def matches(record: dict, field: str, op: str, value: str) -> bool:
+    actual = record.get(field)
+    if actual is None:
+        return op == "$ne"
+    if isinstance(actual, (int, float)) and not isinstance(actual, bool):
+        try:
+            value = float(value)
+        except ValueError:
+            pass
+    else:
+        actual = str(actual)
+    try:
+        return {
+            "$eq": lambda: actual == value,
+            "$ne": lambda: actual != value,
+            "$gte": lambda: actual >= value,
+            "$gt": lambda: actual > value,
+            "$lte": lambda: actual <= value,
+            "$lt": lambda: actual < value,
+        }[op]()
+    except TypeError:
+        return False
+
+
+class Collection:
+    """Records sorted by their timestamp string, so range queries on it are bisects."""
+
+    def __init__(self, name: str, records: list):
+        self.field = timestampvariable(name)
+        self.records = sorted(records, key=lambda record: record[self.field])
+        self.keys = [record[self.field] for record in self.records]
+
+    def find(self, conditions: list, count: int) -> list:
+        lo, hi = 0, len(self.records)
+        others = []
+        for field, op, value in conditions:
+            if field == self.field and op == "$gte":
+                lo = max(lo, bisect_left(self.keys, value))
+            elif field == self.field and op == "$gt":
+                lo = max(lo, bisect_right(self.keys, value))
+            elif field == self.field and op == "$lte":
+                hi = min(hi, bisect_right(self.keys, value))
+            elif field == self.field and op == "$lt":
+                hi = min(hi, bisect_left(self.keys, value))
+            else:
+                others.append((field, op, value))
+
+        found = []
+        for index in range(hi - 1, lo - 1, -1):
+            record = self.records[index]
+            if all(matches(record, field, op, value) for field, op, value in others):
+                found.append(record)
+                if len(found) >= count:
+                    break
+        return found
+
+
+def parse_find(query: list) -> list:
+    # find[field][$op]=value  or  find[field]=value
+    conditions = []
+    for key, value in query:
+        if not key.startswith("find["):
+            continue
+        parts = key[len("find["):].rstrip("]").split("][")
+        conditions.append((parts[0], parts[1] if len(parts) > 1 else "$eq", value))
+    return conditions
+
+
+class StandInServer:
+    def __init__(self, patients: dict, *, latency: float = 0.0, latency_per_record: float = 0.0,
+                 error_rate: float = 0.0, error_status: int = 503, retry_after: float = None, seed: int = 0,
+                 compress: bool = True, host: str = "127.0.0.1", port: int = 0):
+        """patients is {nsid: {"entries": [...], "treatments": [...], "profiles": [...]}}."""
+        self.latency = latency
+        self.latency_per_record = latency_per_record
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.compress = compress
+        self.requests = 0
+        self.errors = 0
+        self.bytes_sent = 0
+        self._rng = random.Random(seed)
+        self._collections = {
+            nsid: {name: Collection(name, records) for name, records in patient.items()}
+            for nsid, patient in patients.items()
+        }
+        self._lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer((host, port), self._handler())
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        """Template for urlformater.BASE_URL."""
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}/{{nsid}}/"
+
+    def respond(self, path: str):
+        """(status, body) for a request path; the HTTP handler serves this, and it can be called without a socket."""
+        parts = urlsplit(path)
+        segments = parts.path.strip("/").split("/")
+        if len(segments) != 4 or segments[1:3] != ["api", "v1"] or not segments[3].endswith(".json"):
+            return 404, b'{"status": 404}'
+        nsid, name = segments[0], segments[3][:-len(".json")]
+        collection = self._collections.get(nsid, {}).get(name)
+        if collection is None:
+            return 200, b"[]"
+        query = parse_qsl(parts.query)
+        options = dict(query)
+        found = collection.find(parse_find(query), int(options.get("count", DEFAULT_COUNT)))
+        return 200, json.dumps(found).encode()
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"  # keep-alive, like the real site
+            disable_nagle_algorithm = True  # headers and body go out as separate writes
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if server.latency:
+                    time.sleep(server.latency)
+                with server._lock:
+                    failing = server._rng.random() < server.error_rate
+                    if failing:
+                        server.errors += 1
+                if failing:
+                    body = json.dumps({"status": server.error_status}).encode()
+                    self.send_response(server.error_status)
+                    if server.retry_after is not None:
+                        self.send_header("Retry-After", str(server.retry_after))
+                    self.send_header("Content-Type", "application/json")
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                    return
+                status, body = server.respond(self.path)
+                if server.latency_per_record:
+                    time.sleep(server.latency_per_record * body.count(b'"_id"'))
+                compressed = server.compress and "gzip" in self.headers.get("Accept-Encoding", "")
+                if compressed:
+                    body = gzip.compress(body, compresslevel=6)
+                with server._lock:
+                    server.requests += 1
+                    server.bytes_sent += len(body)
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                if compressed:
+                    self.send_header("Content-Encoding", "gzip")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        return Handler
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,81 @@
+"""
+Synthetic Nightscout patients for benchmarks and offline testing.
+
+synthetic_patient() returns {"entries": [...], "treatments": [...], "profiles": [...]} shaped like
+the documents the Nightscout v1 API returns (see ptData/scrappy.json), newest first.
+"""
+import random
+from datetime import datetime, timedelta, timezone
+
+
+def isostring(when: datetime) -> str:
+    return when.astimezone(timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.") + f"{when.microsecond // 1000:03d}Z"
+
+
+def epoch_ms(when: datetime) -> int:
+    return int(when.timestamp() * 1000)
+
+
+def profile_document(start: datetime, tz: str, rng: random.Random, dia: float = 6) -> dict:
+    basal = []
+    for hour in range(0, 24, rng.choice([1, 2, 3])):
+        basal.append({"time": f"{hour:02d}:00", "timeAsSeconds": hour * 3600, "value": round(rng.uniform(0.1, 1.5), 2)})
+    return {
+        "_id": f"p{epoch_ms(start):x}",
+        "defaultProfile": "default",
+        "startDate": isostring(start),
+        "mills": epoch_ms(start),
+        "store": {"default": {"timezone": tz, "dia": dia, "units": "mmol", "basal": basal}},
+    }
+
+
+def synthetic_patient(days: int = 14, *, start: datetime = datetime(2024, 1, 1, tzinfo=timezone.utc),
+                      tz: str = "America/Vancouver", cgm_minutes: int = 5, temp_basals_per_hour: float = 4,
+                      boluses_per_day: int = 6, profile_switches: int = 2, seed: int = 0) -> dict:
+    """
+    days                  length of the data, ending at start + days
+    cgm_minutes           CGM reading interval (5 for most sensors, 1 for some)
+    temp_basals_per_hour  average number of temp basals a loop sets per hour
+    boluses_per_day       average number of boluses per day
+    profile_switches      profile changes inside the range (one more profile precedes it)
+    """
+    rng = random.Random(seed)
+    end = start + timedelta(days=days)
+
+    profiles = [profile_document(start - timedelta(days=1), tz, rng)]
+    for _ in range(profile_switches):
+        switch = start + timedelta(seconds=rng.uniform(0, days * 86400))
+        profiles.append(profile_document(switch, tz, rng))
+
+    entries = []
+    when = start + timedelta(seconds=rng.uniform(0, 60))
+    sgv = 120.0
+    while when < end:
+        sgv = min(max(sgv + rng.gauss(0, 6), 40), 400)
+        entries.append({"_id": f"e{len(entries):x}", "type": "sgv", "sgv": round(sgv), "direction": "Flat",
+                        "device": "synthetic", "date": epoch_ms(when), "dateString": isostring(when)})
+        when += timedelta(minutes=cgm_minutes, milliseconds=rng.randint(-500, 500))
+
+    treatments = []
+    if temp_basals_per_hour > 0:
+        when = start
+        while when < end:
+            treatments.append({"_id": f"t{len(treatments):x}", "eventType": "Temp Basal", "created_at": isostring(when),
+                               "date": epoch_ms(when), "rate": round(rng.uniform(0, 3), 2), "duration": 30,
+                               "insulin": None})
+            when += timedelta(minutes=rng.expovariate(temp_basals_per_hour / 60))
+    if boluses_per_day > 0:
+        when = start
+        while when < end:
+            when += timedelta(minutes=rng.expovariate(boluses_per_day / 1440))
+            if when < end:
+                treatments.append({"_id": f"b{len(treatments):x}", "eventType": "Meal Bolus",
+                                   "created_at": isostring(when), "date": epoch_ms(when),
+                                   "insulin": round(rng.uniform(0.5, 8), 1)})
+
+    newest_first = lambda records, field: sorted(records, key=lambda record: record[field], reverse=True)
+    return {
+        "entries": newest_first(entries, "dateString"),
+        "treatments": newest_first(treatments, "created_at"),
+        "profiles": newest_first(profiles, "startDate"),
+    }
@@ -1,3 +1,50 @@
+from datetime import datetime, timedelta, timezone
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+# Epoch-millisecond fields Nightscout stores next to the timestamp strings
+NUMERIC_FIELDS = ('date', 'mills')
+
 # Removes decimals and timezone from time.
 def timeclean(date: str):
-    return date.rsplit('.', 1)[0].replace("Z", "")
\ No newline at end of file
+    return date.rsplit('.', 1)[0].replace("Z", "")
+
+def parse_timestamp(date: str) -> datetime:
+    """Aware UTC datetime of a Nightscout timestamp string, keeping the milliseconds."""
+    try:
+        parsed = datetime.fromisoformat(date)
+    except ValueError:
+        # offsets and fractions fromisoformat doesn't take; drop them as timeclean always did
+        parsed = datetime.fromisoformat(timeclean(date))
+    if parsed.tzinfo is None:
+        return parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc)
+
+def numeric_ms(record: dict):
+    """The record's epoch milliseconds from its numeric fields, or None if it only has strings."""
+    for field in NUMERIC_FIELDS:
+        value = record.get(field)
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return int(value)
+    return None
+
+def record_ms(record: dict, field: str) -> int:
+    """Epoch milliseconds of a record, preferring the numeric fields over the `field` string."""
+    ms = numeric_ms(record)
+    if ms is None:
+        ms = (parse_timestamp(record[field]) - EPOCH) // timedelta(milliseconds=1)
+    return ms
+
+def record_datetime(record: dict, field: str) -> datetime:
+    """Aware UTC datetime of a record, preferring the numeric fields over the `field` string."""
+    ms = numeric_ms(record)
+    if ms is None:
+        return parse_timestamp(record[field])
+    return EPOCH + timedelta(milliseconds=ms)
+
+def timestamps_ms(dates):
+    """Parse a column of timestamp strings at once to an int64 array of epoch milliseconds (naive = UTC)."""
+    import numpy as np
+    import pandas as pd
+    if len(dates) == 0:
+        return np.empty(0, dtype=np.int64)
+    return pd.to_datetime(list(dates), utc=True, format="ISO8601").as_unit("ms").asi8
@@ -1,31 +1,39 @@
 from dataretriever import *
-from datetime import timezone
+from records import parse_treatments
 # CHECK IF SUSPEND PUMP EVENT SHOWS ENDPOINT IN NS (RESUSPEND?). Check if we are missing any
 # variables
 def treatmenttimes(treatments):
     tempprofile = {}
     boluscount = {}
+    field = timestampvariable("treatments")
     for n in treatments:
         if n["eventType"] == "Temp Basal":
-            date = datetime.fromisoformat(timeclean(n["created_at"]))
+            date = record_datetime(n, field)
             rate = n["rate"]
             duration = n["duration"]
-            tempprofile[date.replace(tzinfo=timezone.utc)] = {"rate": rate, "duration": duration}
+            tempprofile[date] = {"rate": rate, "duration": duration}
         elif n["eventType"] == "Suspend Pump":
-            date = datetime.fromisoformat(timeclean(n["created_at"]))
+            date = record_datetime(n, field)
             rate = 0
             duration = 30  # no duration provided
-            tempprofile[date.replace(tzinfo=timezone.utc)] = {"rate": rate, "duration": duration}
+            tempprofile[date] = {"rate": rate, "duration": duration}
         elif float(n["insulin"] or 0) > 0:
-            date = datetime.fromisoformat(timeclean(n["created_at"]))
+            date = record_datetime(n, field)
             insulin = n["insulin"]
-            boluscount[date.replace(tzinfo=timezone.utc)] = insulin
+            boluscount[date] = insulin
+    instrumentation.count("parsed.temp_basals", len(tempprofile))
+    instrumentation.count("parsed.boluses", len(boluscount))
     return [tempprofile, boluscount]
 
 
-def treatmentinsulin(nsid, startdate, enddate):
-    outputdata = dataFetcher(nsid, "treatments", startdate, enddate)
-    #[print(n) for n in outputdata]
+def treatmentinsulin(nsid, startdate, enddate, page_size=PAGE_SIZE, shards=1, compact=False):
+    """compact=True returns records.TempBasals/Boluses columns instead of the two dicts."""
+    if shards > 1:
+        outputdata = shardedFetcher(nsid, "treatments", startdate, enddate, shards, page_size=page_size)
+    else:
+        outputdata = recordFetcher(nsid, "treatments", startdate, enddate, page_size=page_size)
+    if compact:
+        return parse_treatments(outputdata)
     tempdic, bolusdic = treatmenttimes(outputdata)
     #print(tempdic, bolusdic)
     return tempdic, bolusdic
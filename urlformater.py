@@ -1,3 +1,22 @@
+import os
+from urllib.parse import quote
+
+# Default number of records requested per page
+PAGE_SIZE = 1000
+
+# Nightscout site for a patient; override (e.g. NIGHTSCOUT_URL=http://127.0.0.1:8080/{nsid}/) to
+# point at a local stand-in server
+BASE_URL = os.environ.get("NIGHTSCOUT_URL", "https://{nsid}.cgm.bcdiabetes.ca/")
+
+# Conditions sent as find[field]=value for each collection. Nightscout's v1 API has no field
+# projection, so whole records come back.
+COLLECTION_QUERIES = {
+    "entries": {"filters": {"type": "sgv"}},
+    # boluses come under many event types, so treatments are not filtered by eventType
+    "treatments": {"filters": {}},
+    "profiles": {"filters": {}},
+}
+
 def timestampvariable(type):
     if type == "treatments":
         entrydatevariable = "created_at"
@@ -10,8 +29,22 @@ def timestampvariable(type):
 
     return entrydatevariable
 
-def urlformater(ptID: str, type: str, startDate, endDate):
+def baseurl(ptID: str):
+    return BASE_URL.format(nsid=ptID)
+
+def urlformater(ptID: str, type: str, startDate, endDate, count: int = PAGE_SIZE, filtered: bool = True,
+                inclusive: bool = True):
     timestamp = timestampvariable(type)
-    url = "https://" + ptID +".cgm.bcdiabetes.ca/"
-    apiURL = url + "api/v1/" + type + ".json?find[" + timestamp + "][$gte]=" + str(startDate) + "&find[" + timestamp + "][$lte]=" + str(endDate) + "&count=" + str(1000)
-    return apiURL
\ No newline at end of file
+    url = baseurl(ptID)
+    apiURL = url + "api/v1/" + type + ".json?"
+    # startDate=None leaves the range open-ended so the newest records before endDate come back
+    if startDate is not None:
+        apiURL += "find[" + timestamp + "][$gte]=" + quote(str(startDate), safe=":") + "&"
+    # inclusive=False leaves records stamped exactly endDate out
+    op = "$lte" if inclusive else "$lt"
+    apiURL += "find[" + timestamp + "][" + op + "]=" + quote(str(endDate), safe=":") + "&count=" + str(count)
+    if filtered:
+        query = COLLECTION_QUERIES[type]
+        for field, value in query["filters"].items():
+            apiURL += "&find[" + field + "]=" + quote(str(value))
+    return apiURL